@@ -0,0 +1,122 @@
+from redis.exceptions import NoScriptError
+
+from config import REDIS
+from app.stats import STATS
+from app import counters
+
+# Scripts are sent by SHA1 only, they are loaded into Redis on first use
+INCR = REDIS.register_script(counters.INCR)
+SET_MAX = REDIS.register_script(counters.SET_MAX)
+SET_FIRST = REDIS.register_script(counters.SET_FIRST)
+
+class Batch:
+    def __init__(self):
+        self.values = {}
+        self.writes = []
+        self.roundTrips = 0
+
+    async def fetch(self, *keys):
+        missing = [key for key in keys if key not in self.values]
+        if missing:
+            self.roundTrips += 1
+            self.values.update(zip(missing, await REDIS.mget(missing)))
+        return [self.values[key] for key in keys]
+
+    async def get(self, key):
+        return (await self.fetch(key))[0]
+
+    def forget(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = self.encode(value)
+        self.queue('set', key, value, ex=ex)
+
+    def unlink(self, key):
+        self.values[key] = None
+        self.queue('unlink', key)
+
+    async def incr(self, key, amount=1, ex=None):
+        return await self.atomic(key, INCR, [amount], ex)
+
+    def setMax(self, key, score, value, ex=None):
+        # Nobody waits for the result, so it goes with the other writes
+        self.forget(key)
+        self.script(SET_MAX, [key], [score, value, ex or 0])
+
+    async def setFirst(self, key, value, ex=None):
+        return await self.atomic(key, SET_FIRST, [value], ex)
+
+    async def atomic(self, key, script, args, ex):
+        # Result is what the script left in Redis, so changes made by other workers in the meantime are counted in
+        self.roundTrips += 1
+        result = self.encode(await script(keys=[key], args=[*args, ex or 0]))
+        self.values[key] = result
+        return result
+
+    def hset(self, key, mapping):
+        self.queue('hset', key, mapping=mapping)
+
+    def expire(self, key, seconds):
+        self.queue('expire', key, seconds)
+
+    def publish(self, channel, message):
+        self.queue('publish', channel, message)
+
+    def queue(self, command, *args, **kwargs):
+        self.writes.append((command, args, kwargs, None))
+
+    def script(self, script, keys, args, callback=None):
+        # Script registered with REDIS.register_script, sent with the writes. Callback gets the result after the flush
+        self.writes.append((script, (len(keys), *keys, *args), {}, callback))
+
+    async def execute(self, command, *args, **kwargs):
+        # For commands which result is needed right away
+        self.roundTrips += 1
+        return await getattr(REDIS, command)(*args, **kwargs)
+
+    async def executeMany(self, *commands):
+        # Commands as (command, args, kwargs), all sent in one round trip
+        self.roundTrips += 1
+        pipeline = REDIS.pipeline(transaction=False)
+        for command, args, kwargs in commands:
+            getattr(pipeline, command)(*args, **kwargs)
+        return await pipeline.execute()
+
+    async def flush(self):
+        if self.writes:
+            writes, self.writes = self.writes, []
+            results = await self.send(writes)
+            # Redis forgets scripts on restart, they are loaded again and only the calls which failed are repeated
+            missing = [index for index, result in enumerate(results) if isinstance(result, NoScriptError)]
+            if missing:
+                for script in {writes[index][0] for index in missing}:
+                    self.roundTrips += 1
+                    await REDIS.script_load(script.script)
+                for index, result in zip(missing, await self.send([writes[index] for index in missing])):
+                    results[index] = result
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            for (_, _, _, callback), result in zip(writes, results):
+                if callback is not None:
+                    callback(result)
+
+    async def send(self, writes):
+        self.roundTrips += 1
+        pipeline = REDIS.pipeline(transaction=False)
+        for command, args, kwargs, _ in writes:
+            if isinstance(command, str):
+                getattr(pipeline, command)(*args, **kwargs)
+            else:
+                pipeline.evalsha(command.sha, *args)
+        return await pipeline.execute(raise_on_error=False)
+
+    def finish(self):
+        STATS.incr('redis:requests')
+        STATS.incr('redis:round_trips', self.roundTrips)
+        STATS.observe('redis:round_trips_per_request', self.roundTrips)
+
+    def encode(self, value):
+        return counters.encode(value)
@@ -1,18 +1,50 @@
+import asyncio
 import hashlib
+import secrets
 import time
 import base64
 import json
 import string
 import random
 
-from config import getObfuscator
+from config import REDIS, CHALLENGE_POOL_WAIT, SCRIPT_CACHE_SIZE, getLogger
+from app.ray.cache import Cache
+from app.challenges.producer import PRODUCER
+from app.challenges.paths import PATHS
+from app.obfuscator import OBFUSCATOR, ObfuscatorError
 from Crypto.Cipher import AES
 
+logger = getLogger('b4b.challenges')
+
+OBFUSCATOR_OPTIONS = {
+    'renameGlobals': True,
+    'compact': True,
+    'renameProperties': False,
+    'splitStrings': False,
+    'numbersToExpressions': True,
+    'transformObjectKeys': False,
+    'reservedNames': ['iv', 'Uint8Array'],
+    'selfDefending': True
+}
+
+class ScriptUnavailable(Exception):
+    # Pool is empty, scripts are only generated by PRODUCER so the request has to be retried
+    pass
+
+# Loaded scripts by (pool, key), entries expire together with the Redis key
+SCRIPT_CACHE = Cache('script_cache', SCRIPT_CACHE_SIZE, 0)
+
 class Script:
+    # Scripts of a pool are stored as <POOL>:<key> and indexed by expiry time in challenges:index:<name>
+    POOL = None
+    LIFETIME = None
+    AMOUNT = None
+
     def __init__(self):
         self.code = None
         self.rawCode = None
         self.varNames = None
+        self.expiry = None
         
     def load(self, key, data):
         if len(key) != 32:
@@ -23,8 +55,40 @@ class Script:
         
         self.code = data.get('code', None)
         self.varNames = data.get('vars', None)
+        self.build()
         
         return self
+
+    def build(self):
+        # Encoded once, responses only concatenate
+        self.body = self.getBody()
+        self.names = dict(zip(self.VARIABLES, self.varNames or []))
+
+    def getBody(self):
+        return (self.code or '').encode()
+
+    async def pack(self):
+        # Work done once per script before it is stored, so workers loading it do not repeat it
+        pass
+
+    @classmethod
+    async def fetch(cls, key, batch):
+        # Shared by all rays using the script, so it must not be changed once loaded
+        script = SCRIPT_CACHE.get((cls.POOL, key))
+        if script is not None:
+            return script
+        data, ttl = await batch.executeMany(
+            ('get', (cls.getKey(key),), {}),
+            ('ttl', (cls.getKey(key),), {}),
+        )
+        if data is None or ttl <= 0:
+            return None
+        script = cls().load(key, json.loads(data))
+        if not script:
+            return None
+        script.expiry = time.time() + ttl
+        SCRIPT_CACHE.put((cls.POOL, key), script, ttl)
+        return script
     
     def decrypt(self, data):
         encrypted = base64.b64decode(data)
@@ -49,58 +113,100 @@ class Script:
         }
         
     def getCode(self):
-        if self.code == None:
-            self.varNames = self.getNames()
-        
-            for i, key in enumerate(self.VARIABLES):
-                self.rawCode = self.rawCode.replace('{{' + str(key) + '}}', self.varNames[i])
-                
-            self.rawCode = self.rawCode.replace('{{SCRIPT_ENDPOINT}}', self.endpoint)
-            self.rawCode = self.rawCode.replace('{{SCRIPT_KEY}}', self.encryptionKey)
-            
-            success = False
-            renew = False
-            for _ in range(2):
-                try:
-                    self.code = getObfuscator(renew).obfuscate(self.rawCode, {
-                        'renameGlobals': True,
-                        'compact': True,
-                        'renameProperties': False,
-                        'splitStrings': False,
-                        'numbersToExpressions': True,
-                        'transformObjectKeys': False,
-                        'reservedNames': ['iv', 'Uint8Array'],
-                        'selfDefending': True
-                    }).getObfuscatedCode()
-                    success = True
-                    break
-                except Exception as e:
-                    renew = True
-
-            if success == False:
-                self.code = self.rawCode
-                
         return self.code
+    
+    async def obfuscate(self, attempts=2):
+        # Crashed or stuck worker is replaced, so the next attempt runs in a fresh one
+        for _ in range(attempts):
+            try:
+                return await OBFUSCATOR.obfuscate(self.rawCode, OBFUSCATOR_OPTIONS)
+            except ObfuscatorError as e:
+                logger.warning(f'Script obfuscation failed: {e}')
+        return self.rawCode
         
-    def save(self):
-        pass
+    async def save(self):
+        expiry = time.time() + self.LIFETIME
+        pipeline = REDIS.pipeline(transaction=False)
+        pipeline.set(self.getKey(self.encryptionKey), json.dumps(self.dump()), self.LIFETIME)
+        pipeline.zadd(self.getIndexKey(), {self.encryptionKey: expiry})
+        pipeline.expire(self.getIndexKey(), self.LIFETIME)
+        PATHS.add(self, pipeline)
+        await pipeline.execute()
+
+    @classmethod
+    def getKey(cls, key):
+        return cls.POOL + ':' + str(key)
+
+    @classmethod
+    def getIndexKey(cls):
+        return 'challenges:index:' + cls.POOL.split(':')[-1]
+
+    @classmethod
+    async def pick(cls, batch):
+        # Random script of the pool living at least half of its lifetime more, one living shorter is still better than none.
+        # Pools are filled by PRODUCER, an empty one is waited for while some worker leads generation, None if it stays empty
+        deadline = time.time() + CHALLENGE_POOL_WAIT
+        while True:
+            now = time.time()
+            scripts, leader = await batch.executeMany(
+                ('zrangebyscore', (cls.getIndexKey(), now, '+inf'), {'withscores': True}),
+                ('exists', (PRODUCER.leaderKey,), {}),
+            )
+            if scripts:
+                keys = [key for key, expiry in scripts if expiry > now + cls.LIFETIME / 2] or [key for key, _ in scripts]
+                return random.SystemRandom().choice(keys).decode()
+            if not leader or now >= deadline:
+                return None
+            PRODUCER.wake()
+            await asyncio.sleep(0.2)
     
-    def generate(self, seed=time.time_ns()):
-        self.encryptionKey = self.getString(seed, 32)
+    def prepare(self, seed=None):
+        self.encryptionKey = self.getString(secrets.randbits(128) if seed is None else seed, 32)
         self.filename = self.getScriptFilename()
         self.endpoint = self.getScriptEndpoint()
+        self.varNames = self.getNames()
         self.rawCode = self.getRawCode()
-        self.code = self.getCode()
-        self.save()
+        for i, key in enumerate(self.VARIABLES):
+            self.rawCode = self.rawCode.replace('{{' + str(key) + '}}', self.varNames[i])
+        self.rawCode = self.rawCode.replace('{{SCRIPT_ENDPOINT}}', self.endpoint)
+        self.rawCode = self.rawCode.replace('{{SCRIPT_KEY}}', self.encryptionKey)
+        return self
+
+    async def complete(self, code):
+        self.code = code
+        await self.pack()
+        await self.save()
+        self.expiry = time.time() + self.LIFETIME
+        self.build()
+        SCRIPT_CACHE.put((self.POOL, self.encryptionKey), self, self.LIFETIME)
         return self
+
+    @classmethod
+    async def generateMany(cls, amount):
+        # Obfuscated in one batch over all workers of OBFUSCATOR, failed ones get one more attempt alone
+        scripts = [cls().prepare() for _ in range(amount)]
+        codes = await OBFUSCATOR.obfuscateMany([script.rawCode for script in scripts], OBFUSCATOR_OPTIONS)
+        for script, code in zip(scripts, codes):
+            if isinstance(code, Exception):
+                logger.warning(f'Script obfuscation failed: {code}')
+                code = await script.obfuscate(1)
+            await script.complete(code)
+        return scripts
     
     def getRawCode(self):
         pass
     
     def get(self, key):
-        if self.varNames == None:
-            return None
-        return self.varNames[self.VARIABLES.index(key)]
+        return self.names.get(key)
+
+    def normalize(self, data):
+        # Payload keyed by variable names instead of obfuscated ones of this script, to be stored and scored later
+        variables = {name: key for key, name in self.names.items()}
+        if isinstance(data, dict):
+            return {variables.get(key, key): self.normalize(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.normalize(value) for value in data]
+        return data
     
     def getNames(self):
         varLen = max(len(self.VARIABLES) // len(string.ascii_letters), 1)
@@ -113,8 +219,7 @@ class Script:
                 name += string.ascii_letters[idx]
             names.append(name)
             
-        random.seed(self.encryptionKey)
-        random.shuffle(names)
+        random.Random(self.encryptionKey).shuffle(names)
             
         return names
     
@@ -125,5 +230,5 @@ class Script:
         return self.getString(self.encryptionKey, 32) + '.js'
     
     def getString(self, seed, length):
-        random.seed(seed)
-        return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
\ No newline at end of file
+        generator = random.Random(seed)
+        return ''.join(generator.choice(string.ascii_letters + string.digits) for _ in range(length))
\ No newline at end of file
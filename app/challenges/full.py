@@ -1,18 +1,19 @@
 from fastapi.responses import Response, JSONResponse
-from config import FULL_CHALLENGE_SCRIPT, REDIS, FULL_CHALLENGE_SCRIPT_AMOUNT, FULL_CHALLENGE_SCRIPT_LIFETIME
+from config import FULL_CHALLENGE_SCRIPT, FULL_CHALLENGE_SCRIPT_AMOUNT, FULL_CHALLENGE_SCRIPT_LIFETIME, FULL_CHALLENGE_RULES
 from app.ray.ray import Status
-from app.challenges import Script as BaseScript
+from app.challenges import Script as BaseScript, ScriptUnavailable
+from app.challenges.producer import PRODUCER
+from app.challenges.paths import PATHS
+from app.challenges.rules import RuleSet
 
-import time
-import random
-import json
+RULES = RuleSet.load(FULL_CHALLENGE_RULES)
 
 class FullChallenge:
     def __init__(self, ray):
         self.ray = ray
     
     async def getResponse(self):
-        script = self.getScript()
+        script = await self.getScript()
         if self.ray.request.url.path == script.endpoint:
             body = await self.ray.request.body()
             data = script.decrypt(body)
@@ -20,130 +21,45 @@ class FullChallenge:
             score, logs = self.calcScore(data, script)
             self.ray.score = score
             self.ray.scoreLogs = logs
-            self.ray.updateDB({'score_logs': logs})
+            # Payload is kept to score it again when rules change
+            self.ray.updateDB({'score_logs': {'score': score, 'reasons': logs, 'data': script.normalize(data)}})
             
-            if score >= 100:
+            if RULES.isBot(score):
                 # Блокировка отключена для тестирования
                 self.ray.status = Status.JS_CHALLENGE
                 self.ray.requestType = 'bot'
                 self.ray.updateDB({'full_challenge_status': 'blocked'})
-                self.ray.save()
+                await self.ray.save()
                 
                 return JSONResponse({'ok': True})
             else:
                 self.ray.updateDB({'full_challenge_status': 'verfied'})
                 self.ray.status = Status.JS_CHALLENGE
-                self.ray.save()
+                await self.ray.save()
                 
                 return JSONResponse({'ok': True})
         else:
-            return Response('<script>' + script.getCode() + '</script>', 403) 
+            return Response(script.body, 403) 
                 
-    def getScript(self):
-        script = Script()
-        
-        if self.ray.fullChallengeID is not None and REDIS.exists('challenges:full:' + str(self.ray.fullChallengeID)):
-            script.load(self.ray.fullChallengeID, json.loads(REDIS.get('challenges:full:' + str(self.ray.fullChallengeID))))
-            return script
+    async def getScript(self):
+        if self.ray.fullChallengeID is not None:
+            script = await Script.fetch(self.ray.fullChallengeID, self.ray.batch)
+            if script is not None:
+                return script
         
-        keys = REDIS.keys('challenges:full:*')
-        if len(keys) >= FULL_CHALLENGE_SCRIPT_AMOUNT:
-            random.seed(time.time_ns())
-            random.shuffle(keys)
-            
-            scriptKey = None
-            for key in keys:
-                if REDIS.ttl(key) > FULL_CHALLENGE_SCRIPT_LIFETIME / 2:
-                    scriptKey = key.decode()
-                    break
-                
-            if scriptKey is not None:
-                scriptID = scriptKey.split(':')[-1]
+        scriptID = await Script.pick(self.ray.batch)
+        if scriptID is not None:
+            script = await Script.fetch(scriptID, self.ray.batch)
+            if script is not None:
                 self.ray.fullChallengeID = scriptID
-                self.ray.save()
-                script.load(scriptID, json.loads(REDIS.get(scriptKey)))
+                await self.ray.save()
                 return script
         
-        script.generate()
-        self.ray.fullChallengeID = script.encryptionKey
-        self.ray.save()
-        return script
+        raise ScriptUnavailable(Script.POOL)
             
         
     def calcScore(self, data, script):
-        score = 0
-        reasons = []
-        
-        botVars = data.get(script.get('BOTVARS'), [])
-        if len(botVars) > 0:
-            score += 100
-            reasons.append(f"Automation variables detected: {botVars}")
-        
-        if data.get(script.get('CORES'), 0) <= 2:
-            score += 20
-            reasons.append("Low CPU cores (<= 2)")
-            
-        webgl = data.get(script.get('WEBGL'), {})
-        if webgl:
-            renderer = webgl.get(script.get('WEBGL_RENDERER'), '').lower()
-            vendor = webgl.get(script.get('WEBGL_VENDOR'), '').lower()
-            
-            bad_renderers = ['swiftshader', 'llvmpipe', 'virtualbox', 'vmware', 'software adapter', 'mesa', 'microsoft basic render driver']
-            for bad in bad_renderers:
-                if bad in renderer or bad in vendor:
-                    score += 100
-                    reasons.append(f"Detected VM/Headless Renderer: {renderer}")
-                    break
-        else:
-            score += 50
-            reasons.append(f"WebGL is undefiend")
-            
-        if data.get(script.get('WEBDRIVER')) is True:
-            score += 90
-            reasons.append("Navigator.webdriver is True")
-            
-        jit_time = data.get(script.get('JIT_PERFORMANCE'), 101)
-        if jit_time > 100:
-            score += 20
-            reasons.append(f"Slow JS execution: {jit_time}ms")
-            
-        if data.get(script.get('SCREEN_OW')) == 0 or data.get(script.get('SCREEN_OH')) == 0:
-            score += 80
-            reasons.append("Window outer dimensions are 0 (Headless)")
-        
-        if data.get(script.get('SCREEN_IW')) == data.get(script.get('SCREEN_OW')) and data.get(script.get('SCREEN_IH')) == data.get(script.get('SCREEN_OH')):
-            score += 15
-            reasons.append("No browser chrome detected (Inner == Outer size)")
-        
-        if self.ray.userAgent != data.get(script.get('USERAGENT'), ''):
-            score += 100
-            reasons.append("User agant is different")
-        
-        battery = data.get(script.get('BATTERY'))
-        if battery == "ns":
-            ua = data.get(script.get('USERAGENT'), '').lower()
-            if 'mobile' in ua or 'android' in ua or 'iphone' in ua:
-                score += 50
-                reasons.append("Mobile User-Agent but Battery API not supported")
-        # elif isinstance(battery, dict):
-        #     if battery.get(script.get('BATTERY_LEVEL')) == 1.0 and battery.get(script.get('BATTERY_CHARGING')) is True and battery.get(script.get('BATTERY_CHARGING_TIME')) == 0:
-        #         score += 0
-        #         reasons.append("Suspicious battery state (Always 100% charging)")
-        
-        if data.get(script.get('PLUGINS')) == 0:
-            score += 30
-            reasons.append("No browser plugins detected")
-
-        if data.get(script.get('IS_NATIVE_TO_STR')) is False:
-            score += 100
-            reasons.append("Function.toString was tampered (Prototyping hack)")
-
-        fonts = data.get(script.get('FONTS'), [])
-        if len(fonts) < 3:
-            score += 30
-            reasons.append(f"Too few system fonts: {len(fonts)}")
-        
-        return score, reasons
+        return RULES.evaluate(data, script.ruleKeys, {'userAgent': self.ray.userAgent})
     
 class Script(BaseScript):
     VARIABLES = [
@@ -176,9 +92,19 @@ class Script(BaseScript):
         'PLATFORM',
         'USERAGENT'
     ]
-        
-    def save(self):
-        REDIS.set('challenges:full:' + str(self.encryptionKey), json.dumps(self.dump()), FULL_CHALLENGE_SCRIPT_LIFETIME)
+    POOL = 'challenges:full'
+    LIFETIME = FULL_CHALLENGE_SCRIPT_LIFETIME
+    AMOUNT = FULL_CHALLENGE_SCRIPT_AMOUNT
     
     def getRawCode(self):
-        return FULL_CHALLENGE_SCRIPT
\ No newline at end of file
+        return FULL_CHALLENGE_SCRIPT
+
+    def build(self):
+        super().build()
+        self.ruleKeys = RULES.resolve(self.names)
+
+    def getBody(self):
+        return ('<script>' + (self.code or '') + '</script>').encode()
+
+PRODUCER.register(Script)
+PATHS.register(Script)
@@ -1,12 +1,17 @@
-import random
+import asyncio
+import base64
+import hashlib
+import secrets
 import time
-import string
 import json
 from pathlib import Path
 
-from config import REDIS, INJECT_CHALLENGE_SCRIPT, COLLECT_SESSIONS, INJECT_CHALLENGE_SCRIPT_LIFETIME, INJECT_CHALLENGE_SCRIPT_AMOUNT, getLogger
-from app.challenges import Script as BaseScript
-from fastapi.responses import JSONResponse
+from config import INJECT_CHALLENGE_SCRIPT, COLLECT_SESSIONS, INJECT_CHALLENGE_SCRIPT_LIFETIME, INJECT_CHALLENGE_SCRIPT_AMOUNT, getLogger
+from app.challenges import Script as BaseScript, ScriptUnavailable
+from app.challenges.producer import PRODUCER
+from app.challenges.paths import PATHS
+from fastapi.responses import Response, JSONResponse
+from app import encoding
 from app.ray.ray import Status
 
 from ml.session import Session
@@ -14,8 +19,12 @@ from ml.session import Session
 class InjectChallenge:
     def __init__(self, ray):
         self.ray = ray
-        self.script = self.getScript()
+        self.script = None
         self.logger = getLogger('b4b.challenges.inject')
+
+    async def load(self):
+        self.script = await self.getScript()
+        return self
         
     async def getResponse(self):
         body = await self.ray.request.body()
@@ -26,13 +35,9 @@ class InjectChallenge:
             if event == None:
                 return JSONResponse({'ok': False})
             
-            injectDataKey = 'ray:actions:' + self.ray.group.name + ':' + self.ray.id + ':inject:data'
+            # Only the longest session is kept
             duration = data.get('data', {}).get('duration', 0)
-            if REDIS.exists(injectDataKey):
-                if json.loads(REDIS.get(injectDataKey))['data']['duration'] < duration:
-                    REDIS.set(injectDataKey, json.dumps(data), ex=120)
-            else:
-                REDIS.set(injectDataKey, json.dumps(data), ex=120)
+            self.ray.batch.setMax(self.ray.getActionKey('inject:data'), duration, json.dumps(data), ex=120)
             
             
             if COLLECT_SESSIONS:
@@ -45,6 +50,7 @@ class InjectChallenge:
                 if file.exists():
                     content = json.loads(file.read_text())
                 else:
+                    await self.ray.loadLogs()
                     content = {'data': [], 'ray': self.ray.dump()}
                 
                 if event == 'session_end':
@@ -62,13 +68,13 @@ class InjectChallenge:
                     print('[' + self.ray.requestType + '] Got full session: ' + str(file))
             else:
                 if event == 'session_end':
-                    self.predict(data)
+                    await self.predict(data)
         except Exception as e:
             self.logger.exception(e)
 
         return JSONResponse({'ok': True})
     
-    def predict(self, data):
+    async def predict(self, data):
         session = Session()
         predict = session.predict(data)
         
@@ -76,7 +82,7 @@ class InjectChallenge:
         if predict[1] >= 0.5:
             self.ray.updateDB({'inject_challenge_status': 'verfied'})
             self.ray.status = Status.VERFIED
-            self.ray.save()
+            await self.ray.save()
             return True
         else:
             # Блокировка отключена для тестирования
@@ -84,52 +90,83 @@ class InjectChallenge:
             return False
         
     def getInjectCode(self):
-        return ('<script src="/' + str(self.script.getScriptFilename()) + '"></script>').encode()
+        # Session ID goes with the tag, so the script itself is the same for every page and can be cached
+        sessionID = self.script.getString(secrets.randbits(128), 32)
+        return ('<script src="/' + self.script.filename + '" data-session="' + sessionID + '"></script>').encode()
     
-    def getScriptCode(self):
-        return 'const SESSION_ID="' + self.getString(time.time_ns(), 32) + '";' + self.script.getCode()
+    def getScriptResponse(self):
+        return self.script.getResponse(self.ray.request)
     
-    def getScript(self):
-        script = Script()
-        
-        if self.ray.injectChallengeID is not None and REDIS.exists('challenges:inject:' + str(self.ray.injectChallengeID)):
-            script.load(self.ray.injectChallengeID, json.loads(REDIS.get('challenges:inject:' + str(self.ray.injectChallengeID))))
-            return script
+    async def getScript(self):
+        if self.ray.injectChallengeID is not None:
+            script = await Script.fetch(self.ray.injectChallengeID, self.ray.batch)
+            if script is not None:
+                return script
         
-        keys = REDIS.keys('challenges:inject:*')
-        if len(keys) >= INJECT_CHALLENGE_SCRIPT_AMOUNT:
-            random.seed(time.time_ns())
-            random.shuffle(keys)
-            
-            scriptKey = None
-            for key in keys:
-                if REDIS.ttl(key) > INJECT_CHALLENGE_SCRIPT_LIFETIME / 2:
-                    scriptKey = key.decode()
-                    break
-                
-            if scriptKey is not None:
-                scriptID = scriptKey.split(':')[-1]
+        scriptID = await Script.pick(self.ray.batch)
+        if scriptID is not None:
+            script = await Script.fetch(scriptID, self.ray.batch)
+            if script is not None:
                 self.ray.injectChallengeID = scriptID
-                self.ray.save()
-                script.load(scriptID, json.loads(REDIS.get(scriptKey)))
+                await self.ray.save()
                 return script
         
-        script.generate()
-        self.ray.injectChallengeID = script.encryptionKey
-        self.ray.save()
-        return script
-    
-    def getString(self, seed, length):
-        random.seed(seed)
-        return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+        raise ScriptUnavailable(Script.POOL)
     
+SESSION_SNIPPET = 'const SESSION_ID=document.currentScript.dataset.session;'
+
 class Script(BaseScript):
     VARIABLES = []
+    POOL = 'challenges:inject'
+    LIFETIME = INJECT_CHALLENGE_SCRIPT_LIFETIME
+    AMOUNT = INJECT_CHALLENGE_SCRIPT_AMOUNT
     
-    def save(self):
-        REDIS.set('challenges:inject:' + str(self.encryptionKey), json.dumps(self.dump()), INJECT_CHALLENGE_SCRIPT_LIFETIME)
-    
+    def __init__(self):
+        super().__init__()
+        self.variants = {}
+
     def getRawCode(self):
         return INJECT_CHALLENGE_SCRIPT
+
+    def load(self, key, data):
+        self.variants = {coding: base64.b64decode(value) for coding, value in data.get('variants', {}).items()}
+        return super().load(key, data)
+
+    def dump(self):
+        data = super().dump()
+        data['variants'] = {coding: base64.b64encode(value).decode() for coding, value in self.variants.items() if coding != 'identity'}
+        return data
+
+    async def pack(self):
+        # Highest compression takes hundreds of milliseconds, so it is done once per script and off the event loop
+        self.variants = await asyncio.to_thread(encoding.precompress, self.getBody())
+
+    def build(self):
+        super().build()
+        self.variants = dict(self.variants, identity=self.body)
+        tag = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self.etags = {coding: '"' + tag + ('' if coding == 'identity' else '-' + coding) + '"' for coding in self.variants}
+
+    def getBody(self):
+        # Runs before the obfuscated code, while the script tag is still current
+        return (SESSION_SNIPPET + (self.code or '')).encode()
+
+    def getResponse(self, request):
+        # Scripts stored without some encoding are sent uncompressed rather than compressed here
+        coding = encoding.choose(request.headers.get('accept-encoding'), len(self.body))
+        if coding not in self.variants:
+            coding = 'identity'
+        headers = {
+            'ETag': self.etags[coding],
+            'Cache-Control': 'private, max-age=' + str(max(0, int(self.expiry - time.time()))) + ', immutable',
+            'Vary': 'Accept-Encoding'
+        }
+        if encoding.matchesETag(request.headers.get('if-none-match'), self.etags[coding]):
+            return Response(status_code=304, headers=headers)
+        if coding != 'identity':
+            headers['Content-Encoding'] = coding
+        return Response(self.variants[coding], headers=headers, media_type='text/javascript')
     
-    
\ No newline at end of file
+
+PRODUCER.register(Script)
+PATHS.register(Script)
@@ -0,0 +1,64 @@
+import re
+import time
+
+from config import REDIS, CHALLENGE_PATHS_REFRESH
+from app.stats import STATS
+
+# Script files and endpoints are 32 random letters and digits, optionally with .js
+CANDIDATE = re.compile(r'/[A-Za-z0-9]{32}(\.js)?')
+
+SCRIPT = 'script'
+ENDPOINT = 'endpoint'
+
+class ScriptPaths:
+    # Path of every live script file and endpoint in Redis hash, mirrored by every worker for dispatch before ray lookup
+    def __init__(self, refreshInterval):
+        self.key = 'challenges:paths'
+        self.refreshInterval = refreshInterval
+        self.pools = {}
+        self.routes = {}
+        self.refreshTime = 0
+        STATS.gauge('challenges:paths', lambda: len(self.routes))
+
+    def register(self, script):
+        self.pools[script.POOL] = script
+
+    def getPaths(self, script):
+        return {'/' + script.filename: SCRIPT, script.endpoint: ENDPOINT}
+
+    def add(self, script, pipeline):
+        paths = self.getPaths(script)
+        pipeline.hset(self.key, mapping={path: script.POOL + ' ' + script.encryptionKey + ' ' + kind for path, kind in paths.items()})
+        for path, kind in paths.items():
+            self.routes[path] = (type(script), script.encryptionKey, kind)
+
+    def remove(self, scripts, pipeline):
+        paths = [path for script in scripts for path in self.getPaths(script)]
+        if paths:
+            pipeline.hdel(self.key, *paths)
+            for path in paths:
+                self.routes.pop(path, None)
+
+    def isCandidate(self, path):
+        return CANDIDATE.fullmatch(path) is not None
+
+    async def get(self, path):
+        # (script class, key, kind) of the path, None if no live script has it
+        route = self.routes.get(path)
+        if route is None and time.time() - self.refreshTime > self.refreshInterval:
+            # Scripts are generated by the producer leader, so other workers learn about them here
+            await self.refresh()
+            route = self.routes.get(path)
+        STATS.incr('challenges:paths:' + ('hits' if route is not None else 'misses'))
+        return route
+
+    async def refresh(self):
+        self.refreshTime = time.time()
+        routes = {}
+        for path, value in (await REDIS.hgetall(self.key)).items():
+            pool, key, kind = value.decode().split(' ')
+            if pool in self.pools:
+                routes[path.decode()] = (self.pools[pool], key, kind)
+        self.routes = routes
+
+PATHS = ScriptPaths(CHALLENGE_PATHS_REFRESH)
@@ -0,0 +1,114 @@
+import asyncio
+import secrets
+import time
+
+from config import REDIS, CHALLENGE_PRODUCER_INTERVAL, CHALLENGE_PRODUCER_HORIZON, CHALLENGE_PRODUCER_LEADER_TTL, getLogger
+from app.stats import STATS
+from app.challenges.paths import PATHS
+from app.obfuscator import OBFUSCATOR
+
+# Takes the leadership if nobody has it, prolongs it if it is ours. KEYS: leader key, ARGV: token, TTL
+ELECT = REDIS.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+return 0
+""")
+
+RESIGN = REDIS.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+class ScriptProducer:
+    # Keeps challenge script pools filled ahead of expiry, only the worker holding the leadership generates
+    def __init__(self, interval, horizon, leaderTTL):
+        self.interval = interval
+        self.horizon = horizon
+        self.leaderTTL = leaderTTL
+        self.leaderKey = 'challenges:producer'
+        self.token = secrets.token_hex(8)
+        self.pools = []
+        self.leader = False
+        self.event = None
+        self.task = None
+        self.logger = getLogger('b4b.challenges.producer')
+        STATS.gauge('challenges:producer:leader', lambda: self.leader)
+
+    def register(self, script):
+        self.pools.append(script)
+
+    def start(self):
+        if self.task is None:
+            self.event = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.leader:
+            self.leader = False
+            await RESIGN(keys=[self.leaderKey], args=[self.token])
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+
+    async def elect(self):
+        self.leader = bool(await ELECT(keys=[self.leaderKey], args=[self.token, self.leaderTTL]))
+        return self.leader
+
+    async def run(self):
+        # First round runs right away, so the pools are warm soon after startup
+        while True:
+            try:
+                if await self.elect():
+                    for script in self.pools:
+                        await self.refill(script)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning(f'Script generation failed: {e}')
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refill(self, script):
+        # Scripts are picked while they have half of their lifetime left, those which still will after the horizon are counted
+        now = time.time()
+        index = script.getIndexKey()
+        pipeline = REDIS.pipeline(transaction=False)
+        pipeline.zrangebyscore(index, '-inf', now)
+        pipeline.zremrangebyscore(index, '-inf', now)
+        pipeline.zcount(index, now + script.LIFETIME / 2 + self.horizon, '+inf')
+        expired, _, amount = await pipeline.execute()
+
+        if expired:
+            pipeline = REDIS.pipeline(transaction=False)
+            PATHS.remove([script().load(key.decode(), {}) for key in expired], pipeline)
+            await pipeline.execute()
+
+        # Generated in batches of one script per worker of OBFUSCATOR, leadership may be lost while filling a large pool
+        missing = script.AMOUNT - amount
+        while missing > 0:
+            size = min(missing, OBFUSCATOR.size)
+            start = time.perf_counter()
+            await script.generateMany(size)
+            STATS.observe('challenges:' + index.split(':')[-1] + ':generate', time.perf_counter() - start)
+            missing -= size
+            if missing > 0 and not await self.elect():
+                return
+
+PRODUCER = ScriptProducer(CHALLENGE_PRODUCER_INTERVAL, CHALLENGE_PRODUCER_HORIZON, CHALLENGE_PRODUCER_LEADER_TTL)
@@ -0,0 +1,172 @@
+import json
+
+# Rules are either a condition or {"all": [...]} / {"any": [...]} of conditions, plus weight and reason.
+# Condition: field (nested keys joined by '.'), optional default and transform, op and one of
+# value, valueField (another field) or valueContext (value given with the payload, like the request User-Agent).
+# {value} in reason is the value of the first field of the rule.
+#
+# The rule set is compiled into one Python function: every field is read once, every condition is an inline expression.
+
+MISSING = object()
+
+# Names of payloads which are already keyed by variable names, like stored ones
+IDENTITY = {}
+
+def containsAny(value, items):
+    return isinstance(value, str) and any(item in value for item in items)
+
+def lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+def length(value):
+    return len(value) if hasattr(value, '__len__') else 0
+
+OPERATORS = {
+    'eq': '({0} == {1})',
+    'ne': '({0} != {1})',
+    'lt': '({0} < {1})',
+    'le': '({0} <= {1})',
+    'gt': '({0} > {1})',
+    'ge': '({0} >= {1})',
+    'is': '({0} is {1})',
+    'containsAny': 'containsAny({0}, {1})',
+    'empty': '(not {0})',
+    'notEmpty': 'bool({0})',
+}
+# Only ordering of values of different types raises
+RAISING = {'lt', 'le', 'gt', 'ge'}
+
+TRANSFORMS = {
+    'lower': 'lower',
+    'len': 'length',
+}
+
+class RuleError(ValueError):
+    pass
+
+class Compiler:
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self.variables = []
+        self.raws = {}
+        self.fields = {}
+
+    def constant(self, value, sequence=False):
+        # Literal in the source when possible, it is faster than a global
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return repr(value)
+        if sequence and isinstance(value, list) and all(isinstance(item, (bool, int, float, str)) for item in value):
+            return repr(tuple(value))
+        name = 'C' + str(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def raw(self, keys):
+        # Value as sent, MISSING if absent, each key path is read once
+        keys = tuple(keys)
+        if keys in self.raws:
+            return self.raws[keys]
+        if keys[-1] not in self.variables:
+            self.variables.append(keys[-1])
+        key = 'k' + str(self.variables.index(keys[-1]))
+        name = self.raws[keys] = 'r' + str(len(self.raws))
+        if len(keys) == 1:
+            self.lines.append(f'{name} = data.get({key}, MISSING)')
+        else:
+            parent = self.raw(keys[:-1])
+            self.lines.append(f'{name} = {parent}.get({key}, MISSING) if isinstance({parent}, dict) else MISSING')
+        return name
+
+    def field(self, path, default, transform):
+        # Local variable with the value of the field, shared by all rules using it the same way
+        key = (path, json.dumps(default), transform)
+        if key in self.fields:
+            return self.fields[key]
+        if transform is not None and transform not in TRANSFORMS:
+            raise RuleError('Unknown transform: ' + transform)
+        raw = self.raw(path.split('.'))
+        name = self.fields[key] = 'f' + str(len(self.fields))
+        value = f'({self.constant(default)} if {raw} is MISSING else {raw})'
+        if transform is not None:
+            value = f'{TRANSFORMS[transform]}{value}'
+        self.lines.append(f'{name} = {value}')
+        return name
+
+    def condition(self, spec):
+        # Returns (expression, variable with the first field)
+        for kind, join in [('all', ' and '), ('any', ' or ')]:
+            if kind in spec:
+                parts = [self.condition(part) for part in spec[kind]]
+                if not parts:
+                    raise RuleError('Empty "' + kind + '" condition')
+                return '(' + join.join(expression for expression, _ in parts) + ')', parts[0][1]
+
+        if 'field' not in spec or spec.get('op') not in OPERATORS:
+            raise RuleError('Condition needs a field and one of operators ' + ', '.join(OPERATORS) + ': ' + json.dumps(spec))
+        value = self.field(spec['field'], spec.get('default'), spec.get('transform'))
+        if 'valueField' in spec:
+            other = self.field(spec['valueField'], spec.get('default'), spec.get('transform'))
+        elif 'valueContext' in spec:
+            other = f'context.get({spec["valueContext"]!r})'
+        else:
+            other = self.constant(spec.get('value'), True)
+        expression = OPERATORS[spec['op']].format(value, other)
+        items = spec.get('value')
+        if spec['op'] == 'containsAny' and isinstance(items, list) and items and all(isinstance(item, str) for item in items):
+            # Chain of substring checks, several times faster than a loop over the list
+            expression = f'(isinstance({value}, str) and (' + ' or '.join(f'{item!r} in {value}' for item in items) + '))'
+
+        if spec['op'] in RAISING:
+            # Payloads come from clients, a value of unexpected type just does not match
+            name = 'c' + str(len(self.lines))
+            self.lines += [f'try: {name} = {expression}', f'except TypeError: {name} = False']
+            expression = name
+        return expression, value
+
+    def build(self, rules):
+        checks = []
+        for rule in rules:
+            expression, value = self.condition(rule)
+            reason = self.constant(rule['reason'])
+            if '{value}' in rule['reason']:
+                reason += f'.format(value={value})'
+            checks += [
+                f'if {expression}:',
+                f'    score += {self.constant(rule["weight"])}',
+                f'    reasons.append({reason})',
+            ]
+        keys = ''.join('k' + str(index) + ', ' for index in range(len(self.variables)))
+        body = ['if not isinstance(data, dict): data = {}', f'{keys}= keys'] + self.lines + ['score = 0', 'reasons = []'] + checks + ['return score, reasons']
+        # Helpers are bound as defaults, locals are faster to load than globals
+        source = 'def evaluate(data, keys, context, MISSING=MISSING, lower=lower, length=length, containsAny=containsAny):\n' + '\n'.join('    ' + line for line in body)
+
+        namespace = dict(self.constants, MISSING=MISSING, containsAny=containsAny, lower=lower, length=length)
+        exec(compile(source, '<rules>', 'exec'), namespace)
+        return namespace['evaluate'], source, self.variables
+
+class RuleSet:
+    def __init__(self, spec):
+        self.threshold = spec['threshold']
+        self.function, self.source, self.variables = Compiler().build(spec['rules'])
+        self.identityKeys = self.resolve(IDENTITY)
+
+    @classmethod
+    def load(cls, path):
+        return cls(json.loads(path.read_text()))
+
+    def resolve(self, names):
+        # Keys of the payload read by the rules, names maps variable names to obfuscated ones of a script
+        return tuple(names.get(variable, variable) for variable in self.variables)
+
+    def evaluate(self, data, keys=None, context=None):
+        return self.function(data, self.identityKeys if keys is None else keys, context or {})
+
+    def isBot(self, score):
+        return score >= self.threshold
+
+    def rescore(self, records):
+        # Batch mode for stored payloads keyed by variable names, records are (payload, context)
+        function = self.function
+        keys = self.identityKeys
+        return [function(data, keys, context) for data, context in records]
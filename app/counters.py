@@ -0,0 +1,54 @@
+# Atomic read-modify-write operations on single keys, run as Lua scripts. They return the value left in the key.
+# ARGV: operation arguments, then expiry in seconds (0 keeps the key without expiry).
+
+INCR = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+# Value is stored as '<score>\\n<value>' and only replaced by one with a greater score
+SET_MAX = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local score = tonumber(string.match(current, '^([^\\n]*)\\n'))
+    if score and score >= tonumber(ARGV[1]) then
+        return current
+    end
+end
+local value = ARGV[1] .. '\\n' .. ARGV[2]
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[1], value, 'EX', ARGV[3])
+else
+    redis.call('SET', KEYS[1], value)
+end
+return value
+"""
+
+SET_FIRST = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    return current
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return ARGV[1]
+"""
+
+def encode(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return repr(value).encode()
+
+def getScored(stored):
+    # Value part of a SET_MAX value
+    if stored is None:
+        return None
+    return stored.partition(b'\n')[2]
@@ -0,0 +1,138 @@
+import zlib
+
+from app import stream
+from config import PROXY_GZIP_LEVEL, PROXY_BROTLI_QUALITY, PROXY_COMPRESS_MIN_SIZE, PRECOMPRESS_GZIP_LEVEL, PRECOMPRESS_BROTLI_QUALITY
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings httpx is able to decode when the body has to be modified
+DECODABLE = ['gzip', 'deflate'] + (['br'] if brotli is not None else [])
+# Encodings this module is able to produce, in order of preference
+COMPRESSIBLE = (['br'] if brotli is not None else []) + ['gzip']
+
+def parseAcceptEncoding(header):
+    result = {}
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        result[coding] = quality
+    return result
+
+def isAccepted(accepted, coding):
+    if coding in accepted:
+        return accepted[coding] > 0
+    return accepted.get('*', 0) > 0
+
+def getBackendEncoding(header):
+    # Only ask the backend for what both the client and the inject path can handle
+    accepted = parseAcceptEncoding(header)
+    codings = [coding for coding in DECODABLE if isAccepted(accepted, coding)]
+    return ', '.join(codings) if codings else 'identity'
+
+def choose(header, contentLength=None):
+    if contentLength is not None and int(contentLength) < PROXY_COMPRESS_MIN_SIZE:
+        return None
+    accepted = parseAcceptEncoding(header)
+    for coding in COMPRESSIBLE:
+        if isAccepted(accepted, coding):
+            return coding
+    return None
+
+def precompress(data):
+    # Every producible encoding of a static body at the highest ratio, identity included
+    variants = {'identity': data}
+    for coding in COMPRESSIBLE:
+        if coding == 'br':
+            variants[coding] = brotli.compress(data, quality=PRECOMPRESS_BROTLI_QUALITY)
+        elif coding == 'gzip':
+            compressor = zlib.compressobj(PRECOMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            variants[coding] = compressor.compress(data) + compressor.flush()
+    return variants
+
+def matchesETag(header, etag):
+    # Weak comparison of If-None-Match, as required for GET
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    strip = lambda tag: tag.strip().removeprefix('W/')
+    return any(strip(tag) == strip(etag) for tag in header.split(','))
+
+def getDecoder(coding):
+    # Incremental decoder taking raw chunks and returning decoded bytes, None if the coding is unknown
+    if coding == 'identity':
+        return lambda chunk: chunk
+    if coding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if coding == 'deflate':
+        return inflate()
+    if coding == 'br' and brotli is not None:
+        return brotli.Decompressor().process
+    return None
+
+def inflate():
+    # Deflate is meant to be zlib wrapped, but some servers send it raw
+    decompressor = zlib.decompressobj()
+    first = True
+
+    def decode(chunk):
+        nonlocal decompressor, first
+        if first:
+            first = False
+            try:
+                return decompressor.decompress(chunk)
+            except zlib.error:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return decompressor.decompress(chunk)
+    return decode
+
+async def peek(chunks, coding, size):
+    # Decoded start of the body, chunks are given back raw so the body can still be passed as it is
+    decoder = getDecoder(coding)
+    raw = b''
+    head = b''
+    async for chunk in chunks:
+        raw += chunk
+        head += decoder(chunk)
+        if len(head) >= size:
+            break
+    return head, stream.prepend(raw, chunks)
+
+async def decode(chunks, coding):
+    decoder = getDecoder(coding)
+    async for chunk in chunks:
+        data = decoder(chunk)
+        if data:
+            yield data
+
+async def compress(chunks, coding):
+    # Every chunk is flushed, so compression never delays the first byte of the page
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=PROXY_BROTLI_QUALITY)
+        async for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    elif coding == 'gzip':
+        compressor = zlib.compressobj(PROXY_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        async for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    else:
+        raise ValueError('Unsupported encoding: ' + str(coding))
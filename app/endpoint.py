@@ -1,37 +1,182 @@
 import config
 import time
+import httpx
 from enum import Enum
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 from app.ray.group import Group as RayGroup
 from app.ray.ray import Status
+from app.ray.state import STATE
+from app.ray.ratelimit import RATE_LIMITER
+from app.stats import STATS
+from app.batch import Batch
+from app.ray.codec import decodeRay
 
 class Endpoint:
-    def __init__(self, host: str, endpointAddress: str, rayGroup: RayGroup):
+    def __init__(
+        self,
+        host: str,
+        endpointAddress: str,
+        rayGroup: RayGroup,
+        timeout: float = config.ENDPOINT_TIMEOUT,
+        connectTimeout: float = config.ENDPOINT_CONNECT_TIMEOUT,
+        maxConnections: int = config.ENDPOINT_MAX_CONNECTIONS,
+        maxKeepaliveConnections: int = config.ENDPOINT_MAX_KEEPALIVE_CONNECTIONS,
+        keepaliveExpiry: float = config.ENDPOINT_KEEPALIVE_EXPIRY,
+        http2: bool = config.ENDPOINT_HTTP2,
+        stream: bool = config.ENDPOINT_STREAMING,
+        maxBodySize: int = config.ENDPOINT_MAX_BODY_SIZE
+    ):
         self.host = host
         self.address = endpointAddress
         self.rayGroup = rayGroup
+        self.stream = stream
+        self.maxBodySize = maxBodySize
+        self.inUse = 0
+
+        # Client is shared between all visitors, so it must never keep backend cookies
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                verify=False,
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=maxConnections,
+                    max_keepalive_connections=maxKeepaliveConnections,
+                    keepalive_expiry=keepaliveExpiry
+                )
+            ),
+            timeout=httpx.Timeout(timeout, connect=connectTimeout),
+            cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])),
+            follow_redirects=False
+        )
+        STATS.gauge('endpoint:' + host + ':pool', self.getPoolStats)
 
     async def handleRequest(self, request):
-        ray = self.rayGroup.getRay(request)
+        rayID = request.cookies.get(config.RAY_NAME)
+        key = self.rayGroup.getKey(rayID) if rayID is not None else None
+        startTime = time.perf_counter()
+        waited = False
+        batch = Batch()
+        data = None
+        # Every request is counted by the rate limiter once, under the status it was served with
+        limitStatus = None
+        exceeded = None
+
+        if config.VERDICT_TOKEN:
+            ray = await self.rayGroup.getVerifiedRay(request, batch)
+            if ray is not None:
+                limitStatus = ray.status
+                exceeded = RATE_LIMITER.hit(ray, limitStatus)
+                # Rays over the limit are verified the usual way and escalated after it
+                if exceeded is None:
+                    ray.saveRequest()
+                    return EndpointResponse(ray, EndpointResponseStatus(ray.status.value))
 
         while True:
-            if not ray.verify() in [Status.UNVERFIED, Status.VERIFING]:
+            # Only one request per ray is verified at a time in this worker, the rest reuse its result
+            flight = STATE.begin(key) if key is not None else None
+            if key is not None and flight is None and self.getWaitLeft(startTime) > 0:
+                waited = True
+                data = await STATE.join(key, self.getWaitLeft(startTime))
+                batch.forget(key)
+                continue
+
+            ray = None
+            try:
+                ray = await self.rayGroup.getRay(request, batch, data)
+                status = await ray.verify()
+            finally:
+                if flight is not None:
+                    STATE.end(key, flight, ray.dump() if ray is not None else None)
+
+            if status not in [Status.UNVERFIED, Status.VERIFING]:
+                break
+
+            if self.getWaitLeft(startTime) <= 0:
+                ray.status = Status.FULL_JS_CHALLENGE
+                ray.verifyLogs.append('Verification wait timed out. Set status to FULL JS CHALLENGE')
+                STATS.incr('ray:wait_timeouts')
+                # Saving announces the new status, so the other waiting requests get it too
+                await ray.save()
                 break
-            time.sleep(0.1)
-            
+
+            # Status is changed by another request, possibly in another worker
+            waited = True
+            key = ray.getKey()
+            await STATE.wait(key, self.getWaitLeft(startTime))
+            batch.forget(key)
+            data = decodeRay(await batch.get(key))
+
+        if waited:
+            STATS.observe('ray:wait', time.perf_counter() - startTime)
+
+        if limitStatus is None:
+            limitStatus = ray.status
+            exceeded = RATE_LIMITER.hit(ray, limitStatus)
+        if ray.limit(limitStatus, exceeded):
+            await ray.save()
+
         ray.saveRequest()
-    
+
         return EndpointResponse(ray, EndpointResponseStatus(ray.status.value))
-    
+
     def getAddress(self) -> str:
         return self.address
 
+    def getWaitLeft(self, startTime):
+        return config.RAY_WAIT_TIMEOUT - (time.perf_counter() - startTime)
+
+    async def send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        startTime = time.perf_counter()
+        waitTime = None
+        sending = False
+
+        async def trace(event, info):
+            nonlocal waitTime, sending
+            # First event after the pool handed out a connection: either a new connect or the request itself
+            if waitTime is None and event.endswith(('connect_tcp.started', 'connect_unix_socket.started', 'send_request_headers.started')):
+                waitTime = time.perf_counter() - startTime
+                STATS.observe('endpoint:' + self.host + ':pool_wait', waitTime)
+            # Connection is used from sending the request until the response is closed, failed requests are closed too
+            if event.endswith('send_request_headers.started') and not sending:
+                sending = True
+                self.inUse += 1
+            elif event.endswith(('response_closed.complete', 'response_closed.failed')) and sending:
+                sending = False
+                self.inUse -= 1
+
+        request.extensions['trace'] = trace
+        STATS.incr('endpoint:' + self.host + ':requests')
+        try:
+            return await self.client.send(request, stream=stream)
+        except Exception:
+            STATS.incr('endpoint:' + self.host + ':errors')
+            raise
+
+    def getPoolStats(self):
+        # Idle connections are known to the pool only, it is left out when the transport has no such pool
+        stats = {'in_use': self.inUse}
+        try:
+            stats['idle'] = sum(1 for connection in self.client._transport._pool.connections if connection.is_idle())
+        except AttributeError:
+            pass
+        return stats
+
+    async def close(self):
+        await self.client.aclose()
+
 class EndpointResponse:
     def __init__(self, ray, status):
         self.ray = ray
         self.status = status
+        self.upstream = None
+
+    async def close(self):
+        # Streamed backend response is closed by its body generator only once the body is sent
+        if self.upstream is not None:
+            await self.upstream.aclose()
 
 class EndpointResponseStatus(Enum):
     VERFIED = 'verfied'
     JS_CHALLENGE = 'js_challenge'
     FULL_JS_CHALLENGE = 'full_js_challenge'
-    BLOCKED = 'blocked'
\ No newline at end of file
+    BLOCKED = 'blocked'
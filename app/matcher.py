@@ -0,0 +1,47 @@
+from collections import deque
+
+class KeywordMatcher:
+    # Aho-Corasick automaton compiled into a DFA: one dict lookup per character of the text, whatever the number of keywords
+    def __init__(self, keywords):
+        self.keywords = [keyword.lower() for keyword in keywords if keyword]
+        self.transitions = [{}]
+        self.outputs = [None]
+
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.outputs.append(None)
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            if self.outputs[state] is None:
+                self.outputs[state] = keyword
+
+        # Breadth first, so the failure state of every state is complete before its children are visited
+        failures = [0] * len(self.transitions)
+        queue = deque([0])
+        while queue:
+            state = queue.popleft()
+            for char, child in list(self.transitions[state].items()):
+                failures[child] = self.transitions[failures[state]].get(char, 0) if state else 0
+                if self.outputs[child] is None:
+                    self.outputs[child] = self.outputs[failures[child]]
+                queue.append(child)
+            # Missing transitions of the state are taken from its failure state
+            if state:
+                for char, target in self.transitions[failures[state]].items():
+                    self.transitions[state].setdefault(char, target)
+
+    def search(self, text):
+        # Returns the keyword which is found first in the text, None if there is none
+        if not text:
+            return None
+        transitions = self.transitions
+        outputs = self.outputs
+        state = 0
+        for char in text.lower():
+            state = transitions[state].get(char, 0)
+            if outputs[state] is not None:
+                return outputs[state]
+        return None
@@ -0,0 +1,20 @@
+// Worker of app/obfuscator.py: one JSON job per line on stdin, one JSON result per line on stdout
+const readline = require('readline');
+const JavaScriptObfuscator = require('javascript-obfuscator');
+
+const lines = readline.createInterface({input: process.stdin, crlfDelay: Infinity});
+
+lines.on('line', (line) => {
+    const job = JSON.parse(line);
+    let result;
+    try {
+        result = {id: job.id, code: JavaScriptObfuscator.obfuscate(job.code, job.options).getObfuscatedCode()};
+    } catch (e) {
+        result = {id: job.id, error: String(e)};
+    }
+    process.stdout.write(JSON.stringify(result) + '\n');
+});
+
+lines.on('close', () => process.exit(0));
+// Python side is gone
+process.stdout.on('error', () => process.exit(0));
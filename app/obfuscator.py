@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import json
+import time
+from pathlib import Path
+
+from config import OBFUSCATOR_WORKERS, OBFUSCATOR_TIMEOUT, getLogger
+from app.stats import STATS
+
+WORKER_SCRIPT = Path(__file__).parent / 'obfuscator.js'
+
+class ObfuscatorError(Exception):
+    pass
+
+class Worker:
+    # Long running Node process, jobs are pipelined through stdin and their results are matched to pending futures by job id
+    def __init__(self):
+        self.process = None
+        self.reader = None
+        self.pending = {}
+        self.lock = asyncio.Lock()
+
+    def isAlive(self):
+        # Exited process may not be reaped yet, but its output is closed
+        return self.process is not None and self.process.returncode is None and not self.process.stdout.at_eof()
+
+    async def ensure(self):
+        async with self.lock:
+            if self.isAlive():
+                return
+            if self.process is not None:
+                STATS.incr('obfuscator:restarts')
+            self.process = await asyncio.create_subprocess_exec(
+                'node', str(WORKER_SCRIPT),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=64 * 1024 * 1024
+            )
+            self.reader = asyncio.create_task(self.read(self.process))
+
+    async def read(self, process):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                result = json.loads(line)
+                future = self.pending.pop(result['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in result:
+                    future.set_exception(ObfuscatorError(result['error']))
+                else:
+                    future.set_result(result['code'])
+        finally:
+            if process is self.process:
+                self.fail('Obfuscator worker exited')
+
+    def fail(self, reason):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ObfuscatorError(reason))
+        self.pending.clear()
+
+    async def submit(self, jobID, code, options):
+        # Registered before the process is started, so jobs submitted together are spread over workers
+        future = asyncio.get_running_loop().create_future()
+        self.pending[jobID] = future
+        try:
+            await self.ensure()
+            self.process.stdin.write(json.dumps({'id': jobID, 'code': code, 'options': options}).encode() + b'\n')
+            await self.process.stdin.drain()
+        except Exception:
+            self.pending.pop(jobID, None)
+            future.cancel()
+            raise
+        return future
+
+    async def kill(self):
+        process = self.process
+        if process is None:
+            return
+        self.process = None
+        self.fail('Obfuscator worker killed')
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if self.reader is not None:
+            await self.reader
+
+class ObfuscatorPool:
+    # Spreads obfuscation over Node processes on all cores, a stuck or crashed process is replaced on next use
+    def __init__(self, size, timeout):
+        self.timeout = timeout
+        self.size = size
+        self.workers = [Worker() for _ in range(size)]
+        self.jobs = itertools.count()
+        self.logger = getLogger('b4b.obfuscator')
+        STATS.gauge('obfuscator:pending', lambda: sum(len(worker.pending) for worker in self.workers))
+
+    async def obfuscate(self, code, options):
+        worker = min(self.workers, key=lambda worker: len(worker.pending))
+        start = time.perf_counter()
+        try:
+            future = await worker.submit(next(self.jobs), code, options)
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # Obfuscation is synchronous in the worker, so the only way to stop it is to kill it
+            STATS.incr('obfuscator:timeouts')
+            self.logger.warning(f'Obfuscation took over {self.timeout}s, restarting worker')
+            await worker.kill()
+            raise ObfuscatorError('Obfuscation timed out')
+        except OSError as e:
+            STATS.incr('obfuscator:errors')
+            await worker.kill()
+            raise ObfuscatorError(f'Obfuscator worker failed: {e}')
+        except ObfuscatorError:
+            STATS.incr('obfuscator:errors')
+            raise
+        STATS.observe('obfuscator:time', time.perf_counter() - start)
+        return result
+
+    async def obfuscateMany(self, codes, options):
+        # Results in order of codes, failed ones are ObfuscatorError instances
+        return await asyncio.gather(*[self.obfuscate(code, options) for code in codes], return_exceptions=True)
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.kill()
+
+OBFUSCATOR = ObfuscatorPool(OBFUSCATOR_WORKERS, OBFUSCATOR_TIMEOUT)
@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict
+
+from config import RAY_CACHE_SIZE, RAY_CACHE_TTL, VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL, VERDICT_CACHE_FLUSH_INTERVAL, DB, getLogger
+from app.ray.state import STATE
+from app.stats import STATS
+
+class Cache:
+    def __init__(self, name, size, ttl):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        STATS.gauge(name + ':size', lambda: len(self.items))
+        STATS.gauge(name + ':hit_rate', lambda: self.hits / (self.hits + self.misses) if self.hits + self.misses else None)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.miss()
+            return None
+        # TTL is the upper bound for staleness even if invalidation message was lost
+        if time.monotonic() > item[0]:
+            del self.items[key]
+            self.drop(item[1])
+            STATS.incr(self.name + ':expired')
+            self.miss()
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        STATS.incr(self.name + ':hits')
+        return item[1]
+
+    def miss(self):
+        self.misses += 1
+        STATS.incr(self.name + ':misses')
+
+    def put(self, key, data, ttl=None):
+        self.items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), data)
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.drop(evicted)
+            STATS.incr(self.name + ':evictions')
+
+    def drop(self, data):
+        # Called for expired and evicted entries
+        pass
+
+    def invalidate(self, key):
+        if self.items.pop(key, None) is not None:
+            STATS.incr(self.name + ':invalidations')
+
+    def clear(self):
+        self.items.clear()
+
+class RayCache(Cache):
+    def onState(self, key, status, source):
+        # Own changes are already written through
+        if source != STATE.source:
+            self.invalidate(key)
+
+RAY_CACHE = RayCache('ray_cache', RAY_CACHE_SIZE, RAY_CACHE_TTL)
+STATE.subscribe(RAY_CACHE.onState, RAY_CACHE.clear)
+
+class VerdictCache(Cache):
+    # Entries are lists of status, app accuracy, verify logs, DB ID of the first ray with the verdict,
+    # repeats of the client not yet written to that ray and time they were written last
+    STATUS = 0
+    ACCURACY = 1
+    LOGS = 2
+    DB_ID = 3
+    REPEATS = 4
+    FLUSH_TIME = 5
+
+    def __init__(self, name, size, ttl, flushInterval):
+        super().__init__(name, size, ttl)
+        self.flushInterval = flushInterval
+        self.logger = getLogger('b4b.verdict_cache')
+
+    def add(self, key, status, accuracy, logs):
+        entry = [status, accuracy, logs, None, 0, 0]
+        self.put(key, entry)
+        return entry
+
+    def repeat(self, entry):
+        # First repeat is written right away, the next ones at most once per flush interval
+        entry[self.REPEATS] += 1
+        now = time.monotonic()
+        if now - entry[self.FLUSH_TIME] >= self.flushInterval:
+            self.flush(entry, now)
+
+    def flush(self, entry, now):
+        amount, entry[self.REPEATS] = entry[self.REPEATS], 0
+        entry[self.FLUSH_TIME] = now
+        if not amount or entry[self.DB_ID] is None:
+            return
+        try:
+            DB.addRayRepeats(entry[self.DB_ID], amount)
+            STATS.incr(self.name + ':flushes')
+        except Exception as e:
+            self.logger.warning(f'Repeats of ray {entry[self.DB_ID]} are lost: {e}')
+
+    def drop(self, entry):
+        self.flush(entry, time.monotonic())
+
+# Verdicts of new rays by (group, IP, User-Agent, JA4), repeated clients are judged the same without running the rules again
+VERDICT_CACHE = VerdictCache('verdict_cache', VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL, VERDICT_CACHE_FLUSH_INTERVAL)
@@ -0,0 +1,156 @@
+import json
+import struct
+
+# Record layout: version byte, then fields as (tag << 3 | type) byte followed by the value.
+# Fields which are None are omitted. Tags must never be reused for other fields.
+VERSION = 1
+
+NONE, FALSE, TRUE, INT, FLOAT, STR, SYMBOL, LIST = range(8)
+
+FIELDS = [
+    (1, 'id'),
+    (2, 'status'),
+    (3, 'score'),
+    (4, 'appAccuracy'),
+    (5, 'fullChallengeID'),
+    (6, 'injectChallengeID'),
+    (7, 'createTime'),
+    (8, 'requestType'),
+    (9, 'logDB'),
+    (10, 'dbID'),
+    (14, 'saveTime'),
+    (15, 'verifyHash'),
+]
+REQUEST_FIELDS = [
+    (11, 'ip'),
+    (12, 'user-agent'),
+    (13, 'ja4_fingerprint'),
+]
+LOG_FIELDS = ['scoreLogs', 'verifyLogs']
+TAGS = {tag: name for tag, name in FIELDS + REQUEST_FIELDS}
+REQUEST_TAGS = {tag for tag, _ in REQUEST_FIELDS}
+
+# Frequent strings are stored as one byte, new ones are only appended
+SYMBOLS = ['unverfied', 'verifing', 'verfied', 'full_js_challenge', 'js_challenge', 'blocked', 'human', 'bot']
+SYMBOL_CODES = {symbol: code for code, symbol in enumerate(SYMBOLS)}
+
+DOUBLE = struct.Struct('<d')
+
+class CodecError(ValueError):
+    pass
+
+def encodeRay(data):
+    out = bytearray([VERSION])
+    for tag, name in FIELDS:
+        writeField(out, tag, data.get(name))
+    request = data.get('request') or {}
+    for tag, name in REQUEST_FIELDS:
+        writeField(out, tag, request.get(name))
+    return bytes(out)
+
+def decodeRay(raw):
+    if raw is None:
+        return None
+    if raw[:1] == b'{':
+        # Legacy JSON record, logs are still inside of it
+        return json.loads(raw)
+    if raw[0] != VERSION:
+        raise CodecError('Unknown ray record version: ' + str(raw[0]))
+
+    data = {name: None for _, name in FIELDS}
+    data['request'] = {name: None for _, name in REQUEST_FIELDS}
+    position = 1
+    while position < len(raw):
+        tag, kind = raw[position] >> 3, raw[position] & 7
+        value, position = readValue(raw, position + 1, kind)
+        if tag in REQUEST_TAGS:
+            data['request'][TAGS[tag]] = value
+        elif tag in TAGS:
+            data[TAGS[tag]] = value
+    return data
+
+def encodeLogs(logs):
+    out = bytearray()
+    writeValue(out, logs)
+    return bytes(out)
+
+def decodeLogs(raw):
+    if raw is None:
+        return None
+    return readValue(raw, 1, raw[0])[0]
+
+def writeField(out, tag, value):
+    if value is not None:
+        writeValue(out, value, tag << 3)
+
+def writeValue(out, value, prefix=0):
+    if value is None:
+        out.append(prefix | NONE)
+    elif value is True:
+        out.append(prefix | TRUE)
+    elif value is False:
+        out.append(prefix | FALSE)
+    elif isinstance(value, int):
+        out.append(prefix | INT)
+        writeVarint(out, (-value << 1) - 1 if value < 0 else value << 1)
+    elif isinstance(value, float):
+        out.append(prefix | FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str) and value in SYMBOL_CODES:
+        out.append(prefix | SYMBOL)
+        out.append(SYMBOL_CODES[value])
+    elif isinstance(value, str):
+        data = value.encode()
+        out.append(prefix | STR)
+        writeVarint(out, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out.append(prefix | LIST)
+        writeVarint(out, len(value))
+        for item in value:
+            writeValue(out, item)
+    else:
+        raise CodecError('Unsupported value: ' + repr(value))
+
+def readValue(raw, position, kind):
+    if kind == NONE:
+        return None, position
+    if kind == FALSE:
+        return False, position
+    if kind == TRUE:
+        return True, position
+    if kind == INT:
+        value, position = readVarint(raw, position)
+        return (value >> 1) ^ -(value & 1), position
+    if kind == FLOAT:
+        return DOUBLE.unpack_from(raw, position)[0], position + DOUBLE.size
+    if kind == SYMBOL:
+        return SYMBOLS[raw[position]], position + 1
+    if kind == STR:
+        size, position = readVarint(raw, position)
+        return bytes(raw[position:position + size]).decode(), position + size
+    if kind == LIST:
+        size, position = readVarint(raw, position)
+        items = []
+        for _ in range(size):
+            item, position = readValue(raw, position + 1, raw[position] & 7)
+            items.append(item)
+        return items, position
+    raise CodecError('Unknown value type: ' + str(kind))
+
+def writeVarint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def readVarint(raw, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = raw[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
@@ -1,41 +1,73 @@
-from config import RAY_NAME, RAY_LEN, REDIS, getLogger
+from config import RAY_NAME, VERDICT_TOKEN_NAME, RATE_LIMITS, getLogger
 
-import random
-import string
-import time
-import json
-import ipaddress
-
-from app.ray.ray import Ray
+from app.ray.ray import Ray, Status
+from app.ray.cache import RAY_CACHE
+from app.ray.codec import decodeRay
+from app.ray import ident
+from app.ray.verdict import VERDICTS
+from app.ray.whitelist import Whitelist
+from app.batch import Batch
 
 class Group:
+    ACTIONS = ['inject:data']
+
     def __init__(self, name : str):
         self.name = name
         self.logger = getLogger('b4b.group.' + name)
-        self.whitelist = []
+        self.whitelist = Whitelist()
+        self.rateLimits = {status: dict(limits) for status, limits in RATE_LIMITS.items()}
         
     def whitelistAdd(self, *subnets):
-        for subnet_str in subnets:
-            if '/' in subnet_str:
-                subnet = ipaddress.ip_network(subnet_str, strict=False)
-            else:
-                subnet = ipaddress.ip_network(f"{subnet_str}/{'128' if ipaddress.ip_address(subnet_str).version == 6 else '32'}", strict=False)
-            self.whitelist.append(subnet)
-
-    def getRay(self, request):
+        self.whitelist.add(*subnets)
+
+    def whitelistReplace(self, subnets):
+        # For refreshed lists, requests keep using the old one until the new one is built
+        self.whitelist.replace(subnets)
+
+    def setRateLimit(self, status, **limits):
+        self.rateLimits.setdefault(status.value, {}).update(limits)
+
+    def getKey(self, rayID):
+        return 'ray:' + self.name + ':' + str(rayID)
+
+    def getLogsKey(self, rayID):
+        return 'ray:logs:' + self.name + ':' + str(rayID)
+
+    def getActionKey(self, rayID, action):
+        return 'ray:actions:' + self.name + ':' + str(rayID) + ':' + action
+
+    async def getRay(self, request, batch=None, data=None):
+        batch = batch or Batch()
         rayID = request.cookies.get(RAY_NAME)
-        if rayID is not None and REDIS.exists('ray:' + self.name + ':' + str(rayID)):
-            ray = Ray(self, rayID, request)
-            ray.load(json.loads(REDIS.get('ray:' + self.name + ':' + str(rayID))))
+        if rayID is not None:
+            if data is None:
+                data = RAY_CACHE.get(self.getKey(rayID))
+
+            # Actions of JS challenge are read along with the ray when it is not cached, otherwise when they are needed
+            if data is None:
+                await batch.fetch(self.getKey(rayID), *(self.getActionKey(rayID, action) for action in self.ACTIONS))
+                if batch.values[self.getKey(rayID)] is not None:
+                    data = decodeRay(batch.values[self.getKey(rayID)])
+                    RAY_CACHE.put(self.getKey(rayID), data)
+
+        if data is not None:
+            ray = Ray(self, rayID, request, batch)
+            ray.load(data)
         else:
-            ray = Ray(self, self._genRayID(), request)
-            ray.save(False)
+            ray = Ray(self, ident.generate(), request, batch)
+            await ray.save(False)
         return ray
 
-    def _genRayID(self):
-        random.seed(time.time_ns())
-        while True:
-            id = (''.join(random.choice(string.ascii_letters + string.digits) for _ in range(RAY_LEN))) + '.' + str(time.time_ns())
-            if REDIS.exists('ray:' + self.name + ':' + id) == 0:
-                break
-        return id
\ No newline at end of file
+    async def getVerifiedRay(self, request, batch):
+        # Ray restored from its verdict token alone, without reading Redis
+        rayID = request.cookies.get(RAY_NAME)
+        token = request.cookies.get(VERDICT_TOKEN_NAME)
+        if rayID is None or token is None:
+            return None
+        verdict = await VERDICTS.check(token, self, rayID, request, batch)
+        if verdict is None or verdict[0] != Status.VERFIED:
+            return None
+        ray = Ray(self, rayID, request, batch)
+        ray.status = ray.savedStatus = verdict[0]
+        ray.logDB, ray.dbID, ray.verdictExpiry = verdict[1:]
+        return ray
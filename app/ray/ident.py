@@ -0,0 +1,22 @@
+import base64
+import os
+import secrets
+import socket
+import struct
+import time
+import zlib
+
+from config import RAY_ID_NODE, RAY_ID_RANDOM_BYTES
+
+# Ray ID layout: 48 bit millisecond timestamp, 16 bit node, random bytes; encoded as unpadded base64url.
+# Node keeps workers apart within the same millisecond, randomness makes IDs unguessable, so no uniqueness check is needed.
+HEADER = struct.Struct('>QH')
+NODE = RAY_ID_NODE if RAY_ID_NODE is not None else zlib.crc32(f'{socket.gethostname()}:{os.getpid()}'.encode()) & 0xffff
+
+def generate():
+    header = HEADER.pack(time.time_ns() // 1000000, NODE)[2:]
+    return base64.urlsafe_b64encode(header + secrets.token_bytes(RAY_ID_RANDOM_BYTES)).rstrip(b'=').decode()
+
+def isLegacy(rayID):
+    # Old IDs are random letters followed by '.' and creation time in nanoseconds
+    return '.' in rayID
@@ -0,0 +1,103 @@
+import ipaddress
+import time
+
+from config import REDIS, RATE_LIMIT_WINDOW, RATE_LIMIT_SYNC_INTERVAL
+from app.stats import STATS
+
+# Sliding window counter: hits of the current window plus the part of the previous one still covered by the window.
+# KEYS are pairs of current and previous window counters, ARGV: window, weight of the previous window, amounts.
+SCRIPT = REDIS.register_script("""
+local result = {}
+local window = tonumber(ARGV[1])
+local weight = tonumber(ARGV[2])
+for i = 1, #KEYS / 2 do
+    local amount = tonumber(ARGV[i + 2])
+    local current = redis.call('INCRBY', KEYS[i * 2 - 1], amount)
+    if current == amount then
+        redis.call('EXPIRE', KEYS[i * 2 - 1], window * 2)
+    end
+    local previous = tonumber(redis.call('GET', KEYS[i * 2]) or '0')
+    result[i] = math.floor(previous * weight + current)
+end
+return result
+""")
+
+class RateLimiter:
+    # Requests are counted locally and sent to Redis with the writes of a request once per sync interval,
+    # or sooner when the local part gets large compared to the limit
+    PENDING = 0
+    ESTIMATE = 1
+    WINDOW = 2
+    SYNC_TIME = 3
+
+    def __init__(self, window, syncInterval):
+        self.window = window
+        self.syncInterval = syncInterval
+        self.entries = {}
+        self.pruneTime = time.time()
+        STATS.gauge('rate_limit:entries', lambda: len(self.entries))
+
+    def getClientKeys(self, ray):
+        ip = ipaddress.ip_address(ray.ip)
+        if ip.version == 6:
+            # Clients usually get a whole /64
+            ip = ipaddress.ip_network(str(ip) + '/64', strict=False)
+        return {'ip': str(ip), 'ray': ray.id, 'ja4': ray.ja4_fingerprint}
+
+    def hit(self, ray, status):
+        # Counts the request under the status and returns the first exceeded limit, None if there is none
+        limits = ray.group.rateLimits.get(status.value)
+        if not limits:
+            return None
+
+        now = time.time()
+        window = int(now // self.window)
+        exceeded = None
+        due = []
+        for name, value in self.getClientKeys(ray).items():
+            limit = limits.get(name)
+            if limit is None or value is None:
+                continue
+            key = 'ratelimit:' + ray.group.name + ':' + status.value + ':' + name + ':' + value
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [0, 0, window, 0]
+            entry[self.PENDING] += 1
+
+            estimate = entry[self.PENDING] + (entry[self.ESTIMATE] if entry[self.WINDOW] == window else 0)
+            if exceeded is None and estimate > limit:
+                exceeded = name
+            if entry[self.WINDOW] != window or now - entry[self.SYNC_TIME] >= self.syncInterval or entry[self.PENDING] >= max(1, limit // 10):
+                due.append((key, entry))
+
+        if due:
+            self.sync(due, now, window, ray.batch)
+        if now - self.pruneTime > self.window:
+            self.prune(now)
+        if exceeded is not None:
+            STATS.incr('rate_limit:exceeded:' + exceeded)
+        return exceeded
+
+    def sync(self, due, now, window, batch):
+        keys = []
+        amounts = []
+        for key, entry in due:
+            keys.extend([key + ':' + str(window), key + ':' + str(window - 1)])
+            amounts.append(entry[self.PENDING])
+            entry[self.PENDING] = 0
+            entry[self.SYNC_TIME] = now
+
+        def update(estimates):
+            for (key, entry), estimate in zip(due, estimates):
+                entry[self.ESTIMATE] = estimate
+                entry[self.WINDOW] = window
+
+        weight = 1 - (now % self.window) / self.window
+        batch.script(SCRIPT, keys, [self.window, weight, *amounts], update)
+        STATS.incr('rate_limit:syncs')
+
+    def prune(self, now):
+        self.pruneTime = now
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[self.PENDING] or now - entry[self.SYNC_TIME] < self.window * 2}
+
+RATE_LIMITER = RateLimiter(RATE_LIMIT_WINDOW, RATE_LIMIT_SYNC_INTERVAL)
@@ -1,14 +1,33 @@
 from enum import Enum
-from config import REDIS, RAY_LIFETIME, JA4_KEY_DETECT, BOT_USERAGENT_KEYWORDS, DB
-import json
+from config import RAY_LEN_SHORT, RAY_LIFETIME, JA4_KEY_DETECT, BOT_USERAGENT_KEYWORDS, VERDICT_CACHE_SKIP_BLOCKED, DB
 import time
+import zlib
 import ipaddress
 
+from app.ray.state import STATE
+from app.ray.cache import RAY_CACHE, VERDICT_CACHE
+from app.ray.codec import encodeRay, encodeLogs, decodeLogs
+from app.ray import ident
+from app.matcher import KeywordMatcher
+from app.stats import STATS
+from app.batch import Batch
+
+BOT_USERAGENT_MATCHER = KeywordMatcher(BOT_USERAGENT_KEYWORDS)
+
 class Ray:
-    def __init__(self, group, id = None, request = None):
+    __slots__ = (
+        'data', 'request', 'group', 'batch', 'checker', 'logDB', 'requestType',
+        'fullChallengeID', 'injectChallengeID', 'dbID',
+        'score', 'scoreLogs', 'savedScore', 'savedScoreLogs', 'verifyLogs', 'createTime', 'appAccuracy',
+        'id', 'status', 'savedStatus', 'ip', 'userAgent', 'ja4_fingerprint', 'ja4_app', 'ja4_raw',
+        'saved', 'saveTime', 'verifyHash', 'verdictExpiry',
+    )
+
+    def __init__(self, group, id = None, request = None, batch = None):
         self.data = None
         self.request = None
         self.group = group
+        self.batch = batch or Batch()
         self.checker = {}
         
         self.logDB = True
@@ -30,6 +49,16 @@ class Ray:
 
         self.id = id
         self.status = Status.UNVERFIED
+        self.savedStatus = None
+        self.saved = None
+        self.saveTime = None
+        self.verifyHash = None
+        self.verdictExpiry = None
+        self.ip = None
+        self.userAgent = None
+        self.ja4_fingerprint = None
+        self.ja4_app = None
+        self.ja4_raw = None
         if request is not None:
             self.request = request
             self.ip = self.request.headers.get('x-forwarded-for')
@@ -42,6 +71,7 @@ class Ray:
     def load(self, data):
         self.id = data['id']
         self.status = Status(data['status']) if any(k.value == data['status'] for k in Status) else Status.UNVERFIED
+        self.savedStatus = self.status
         self.savedScore = data.get('score', None)
         self.savedScoreLogs = data.get('scoreLogs', None)
         self.fullChallengeID = data.get('fullChallengeID', None)
@@ -50,54 +80,116 @@ class Ray:
         self.requestType = data.get('requestType', self.requestType)
         self.dbID = data.get('dbID', None)
         self.logDB = data.get('logDB', True)
+        self.saveTime = data.get('saveTime', None)
+        self.verifyHash = data.get('verifyHash', None)
+        self.saved = data
         self.data = data
     
-    def dump(self):
-        return {
+    def dump(self, logs=True):
+        data = {
             'id': self.id,
             'status': self.status.value,
             'score': self.score if self.score is not None else self.savedScore,
-            'scoreLogs': self.scoreLogs if self.scoreLogs is not None else self.savedScoreLogs,
             'appAccuracy': self.appAccuracy,
             'fullChallengeID': self.fullChallengeID,
             'injectChallengeID': self.injectChallengeID,
-            'verifyLogs': self.verifyLogs,
             'createTime': self.createTime,
             'requestType': self.requestType,
             'logDB': self.logDB,
             'dbID': self.dbID,
+            'saveTime': self.saveTime,
+            'verifyHash': self.verifyHash,
             'request': {
                 'ip': self.ip,
                 'user-agent': self.userAgent,
                 'ja4_fingerprint': self.ja4_fingerprint
             }
         }
+        if logs:
+            data['scoreLogs'] = self.scoreLogs if self.scoreLogs is not None else self.savedScoreLogs
+            data['verifyLogs'] = self.verifyLogs
+        return data
+
+    async def loadLogs(self):
+        # Logs are kept apart from the ray record and only read when someone needs them
+        values = await self.batch.execute('hgetall', self.getLogsKey())
+        if self.savedScoreLogs is None:
+            self.savedScoreLogs = decodeLogs(values.get(b'scoreLogs'))
+        return {name.decode(): decodeLogs(value) for name, value in values.items()}
         
     def saveRequest(self):
         if self.logDB and self.dbID is not None:
             DB.addRequest(self.dbID, time.time_ns(), str(self.request.url), self.status.value)
     
-    def save(self, saveDB=True):
+    async def save(self, saveDB=True):
+        savedVerifyHash = self.verifyHash
+        if self.verifyLogs is not None:
+            self.verifyHash = zlib.crc32('\n'.join(self.verifyLogs).encode())
+        verifyChanged = self.verifyHash != savedVerifyHash
+
+        # Postgres is only touched when the ray is new or its status or verification result changed
         if saveDB and self.logDB:
             if self.dbID is None and not DB.rayExists(self.id, self.group.name):
                 self.dbID = DB.addRay(self.id, self.createTime, self.status.value, self.group.name, self.ip, None, None, None, self.userAgent, self.verifyLogs, self.scoreLogs, None)
-            self.updateDB({'status': self.status.value, 'verify_logs': self.verifyLogs})
-        REDIS.set('ray:' + self.group.name + ':' + str(self.id), json.dumps(self.dump()), RAY_LIFETIME)
+                STATS.incr('ray:db_writes')
+            elif self.status != self.savedStatus or verifyChanged:
+                self.updateDB({'status': self.status.value, 'verify_logs': self.verifyLogs})
+                STATS.incr('ray:db_writes')
+            else:
+                STATS.incr('ray:db_skipped')
+
+        data = self.dump(False)
+        now = int(time.time())
+        changed = self.saved is None or any(value != self.saved.get(name) for name, value in data.items() if name != 'saveTime')
+        # Unchanged rays are rewritten once per half of their lifetime only, to slide the expiry
+        expiring = self.saveTime is None or now - self.saveTime >= RAY_LIFETIME // 2
+        if changed or expiring:
+            self.saveTime = data['saveTime'] = now
+            self.batch.set(self.getKey(), encodeRay(data), ex=RAY_LIFETIME)
+            RAY_CACHE.put(self.getKey(), data)
+            self.saved = data
+            STATS.incr('ray:redis_writes' if changed else 'ray:redis_refreshes')
+        else:
+            STATS.incr('ray:redis_skipped')
+
+        logs = {name: encodeLogs(value) for name, value in [('scoreLogs', self.scoreLogs), ('verifyLogs', self.verifyLogs if verifyChanged else None)] if value is not None}
+        if logs:
+            self.batch.hset(self.getLogsKey(), logs)
+        if logs or expiring:
+            self.batch.expire(self.getLogsKey(), RAY_LIFETIME)
+
+        # Rays created by this request are unknown to anyone else, so only transitions of stored ones are announced
+        if self.data is not None and self.status != self.savedStatus:
+            STATE.publish(self.getKey(), self.status.value, self.batch)
+        self.savedStatus = self.status
         
         
     def updateDB(self, data):
         if self.logDB:
             DB.updateRay(self.dbID, data)
 
-    def verify(self):
+    async def verify(self):
         self.verifyLogs = []
-        ip = ipaddress.ip_address(self.ip)
-        for subnet in self.group.whitelist:
-            if ip in subnet:
-                self.status = Status.VERFIED
-                self.verifyLogs.append('IP in whitelist')
-                self.logDB = False
-                self.save()
+        if ipaddress.ip_address(self.ip) in self.group.whitelist:
+            self.status = Status.VERFIED
+            self.verifyLogs.append('IP in whitelist')
+            self.logDB = False
+            await self.save()
+            return self.status
+
+        # Rules below judge new rays by request alone, so the same client gets the same verdict
+        verdictKey = None
+        if self.data is None and self.request is not None:
+            verdictKey = (self.group.name, self.ip, self.userAgent, self.ja4_app, self.ja4_fingerprint)
+            verdict = VERDICT_CACHE.get(verdictKey)
+            if verdict is not None:
+                self.status, self.appAccuracy, verifyLogs = verdict[:VERDICT_CACHE.DB_ID]
+                self.verifyLogs = verifyLogs + ['Verdict of the same IP, User-Agent and JA4 reused']
+                if self.status == Status.BLOCKED and VERDICT_CACHE_SKIP_BLOCKED:
+                    self.logDB = False
+                    VERDICT_CACHE.repeat(verdict)
+                    STATS.incr('verdict_cache:blocked_skipped')
+                await self.save()
                 return self.status
         
         if self.data is not None and self.request is not None:
@@ -135,22 +227,35 @@ class Ray:
                         self.status = Status.JS_CHALLENGE
                         self.verifyLogs.append('Normal JA4 App accuracy. Set status to JS CHALLENGE')
             else:
-                bot = False
-                for word in BOT_USERAGENT_KEYWORDS:
-                    if word in self.userAgent:
-                        bot = True
-                        break
-                if bot == True:
+                keyword = BOT_USERAGENT_MATCHER.search(self.userAgent)
+                if keyword is not None:
                     self.status = Status.BLOCKED
-                    self.verifyLogs.append('Bot detected in User-Agent. Set status to Blocked')
+                    self.verifyLogs.append(f'Bot detected in User-Agent by keyword "{keyword}". Set status to Blocked')
                 else:
                     self.status = Status.FULL_JS_CHALLENGE
                     self.verifyLogs.append('No JA4 App found, No bot detected. Changed status to FULL_JS_CHALLENGE')
-        
-        self.save()
+
+        verdict = None
+        if verdictKey is not None:
+            verdict = VERDICT_CACHE.add(verdictKey, self.status, self.appAccuracy, list(self.verifyLogs))
+
+        await self.save()
+        if verdict is not None:
+            verdict[VERDICT_CACHE.DB_ID] = self.dbID
 
         return self.status
     
+    def limit(self, status, exceeded):
+        # Escalates the ray if the request, counted under status, went over a limit. True if the status changed
+        escalate = self.group.rateLimits.get(status.value, {}).get('escalate')
+        if exceeded is None or escalate is None or self.status != status:
+            return False
+        self.status = Status(escalate)
+        if self.verifyLogs is None:
+            self.verifyLogs = []
+        self.verifyLogs.append(f'Rate limit by {exceeded} exceeded. Changed status to {self.status.name}')
+        return True
+
     def _getUserAgentAccuracy(self, userAgent, ja4App):
         a = 0
         t = 0
@@ -160,8 +265,19 @@ class Ray:
             t += 1
         return a / t
     
+    def getKey(self):
+        return self.group.getKey(self.id)
+
+    def getLogsKey(self):
+        return self.group.getLogsKey(self.id)
+
+    def getActionKey(self, action):
+        return self.group.getActionKey(self.id, action)
+
     def getShortID(self):
-        return self.id[:12] + self.id.split('.')[1]
+        if ident.isLegacy(self.id):
+            return self.id[:RAY_LEN_SHORT] + self.id.split('.')[1]
+        return self.id
 
 class Status(Enum):
     UNVERFIED = 'unverfied'
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import secrets
+
+from config import REDIS, RAY_STATE_CHANNEL, getLogger
+
+class StateChannel:
+    def __init__(self):
+        self.waiters = {}
+        self.inflight = {}
+        self.listeners = []
+        self.resetListeners = []
+        self.source = secrets.token_hex(8)
+        self.task = None
+        self.logger = getLogger('b4b.ray.state')
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            pubsub = REDIS.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(RAY_STATE_CHANNEL)
+                # Messages sent while not subscribed are lost, so everything derived from them is dropped
+                for callback in self.resetListeners:
+                    callback()
+                async for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    self.notify(data['key'], data['status'], data.get('source'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning(f'State channel failed, reconnecting: {e}')
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def subscribe(self, callback, reset=None):
+        self.listeners.append(callback)
+        if reset is not None:
+            self.resetListeners.append(reset)
+
+    def publish(self, key, status, batch):
+        # Sent together with the ray write, so nobody (this worker included) sees the message before the new state
+        batch.publish(RAY_STATE_CHANNEL, json.dumps({'key': key, 'status': status, 'source': self.source}))
+
+    def notify(self, key, status, source):
+        for callback in self.listeners:
+            callback(key, status, source)
+        for future in self.waiters.pop(key, []):
+            if not future.done():
+                future.set_result(status)
+
+    async def wait(self, key, timeout):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.waiters.get(key)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.waiters[key]
+
+    async def join(self, key, timeout):
+        # Waits for verification of the same ray already running in this worker
+        flight = self.inflight.get(key)
+        if flight is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def begin(self, key):
+        if key in self.inflight:
+            return None
+        flight = self.inflight[key] = asyncio.get_running_loop().create_future()
+        return flight
+
+    def end(self, key, flight, data):
+        # Requests joined to the flight reuse resulting ray data, the write may still be in flight
+        if self.inflight.get(key) is flight:
+            del self.inflight[key]
+        if not flight.done():
+            flight.set_result(data)
+
+STATE = StateChannel()
@@ -0,0 +1,112 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import struct
+import time
+
+from config import VERDICT_TOKEN_LIFETIME, VERDICT_TOKEN_KEY_LIFETIME
+from app.ray.state import STATE
+from app.ray.ray import Status
+from app.ray.codec import SYMBOLS, SYMBOL_CODES
+from app.stats import STATS
+
+class VerdictTokens:
+    # version, key id, status, flags, expiry, ray DB ID, client hash
+    PAYLOAD = struct.Struct('>BIBBIQ8s')
+    VERSION = 1
+    MAC_SIZE = 16
+    LOG_DB = 1
+
+    def __init__(self, lifetime, keyLifetime):
+        self.lifetime = lifetime
+        self.keyLifetime = keyLifetime
+        self.keys = {}
+        self.revoked = {}
+        self.resetTime = None
+        STATS.gauge('verdict:revoked', lambda: len(self.revoked))
+
+    def getKeyID(self, now):
+        return int(now // self.keyLifetime)
+
+    async def getKey(self, keyID, batch, create=False):
+        # Signing keys are shared by all workers through Redis and cached forever, only two of them are ever accepted
+        if keyID in self.keys:
+            return self.keys[keyID]
+        name = 'verdict:key:' + str(keyID)
+        if create:
+            await batch.execute('set', name, secrets.token_bytes(32), nx=True, ex=self.keyLifetime * 3)
+            # Miss cached by an earlier lookup of the same key in this batch is stale now
+            batch.forget(name)
+        key = await batch.get(name)
+        if key is not None:
+            self.keys[keyID] = key
+            for old in [old for old in self.keys if old < keyID - 1]:
+                del self.keys[old]
+        return key
+
+    def getClientHash(self, group, rayID, ip, userAgent, ja4):
+        ja4 = ja4 or ''
+        # Same part of JA4 fingerprint as the one compared by Ray.verify
+        client = '\n'.join([group.name, rayID, ip or '', userAgent or '', ja4[:6] + ja4[8:23]])
+        return hashlib.blake2b(client.encode(), digest_size=8).digest()
+
+    async def sign(self, ray):
+        now = time.time()
+        keyID = self.getKeyID(now)
+        key = await self.getKey(keyID, ray.batch, True)
+        expiry = int(now) + self.lifetime
+        payload = self.PAYLOAD.pack(
+            self.VERSION, keyID, SYMBOL_CODES[ray.status.value], self.LOG_DB if ray.logDB else 0, expiry, ray.dbID or 0,
+            self.getClientHash(ray.group, ray.id, ray.ip, ray.userAgent, ray.ja4_fingerprint)
+        )
+        mac = hmac.new(key, payload, hashlib.sha256).digest()[:self.MAC_SIZE]
+        STATS.incr('verdict:issued')
+        return base64.urlsafe_b64encode(payload + mac).rstrip(b'=').decode(), expiry
+
+    async def check(self, token, group, rayID, request, batch):
+        # Returns (status, logDB, dbID, expiry) of a valid token, None otherwise
+        if not token or self.resetTime is None:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            version, keyID, status, flags, expiry, dbID, clientHash = self.PAYLOAD.unpack_from(raw)
+        except (ValueError, struct.error):
+            STATS.incr('verdict:invalid')
+            return None
+
+        now = time.time()
+        if version != self.VERSION or len(raw) != self.PAYLOAD.size + self.MAC_SIZE or expiry < now or keyID not in [self.getKeyID(now), self.getKeyID(now) - 1]:
+            STATS.incr('verdict:invalid')
+            return None
+        # Tokens issued before the state channel was (re)subscribed may have missed their revocation
+        issueTime = expiry - self.lifetime
+        if issueTime < self.resetTime or issueTime <= self.revoked.get(group.getKey(rayID), 0):
+            STATS.incr('verdict:revoked')
+            return None
+        if clientHash != self.getClientHash(group, rayID, request.headers.get('x-forwarded-for'), request.headers.get('user-agent'), request.headers.get('X-JA4-Fingerprint')):
+            STATS.incr('verdict:invalid')
+            return None
+
+        key = await self.getKey(keyID, batch)
+        if key is None or not hmac.compare_digest(raw[self.PAYLOAD.size:], hmac.new(key, raw[:self.PAYLOAD.size], hashlib.sha256).digest()[:self.MAC_SIZE]):
+            STATS.incr('verdict:invalid')
+            return None
+
+        STATS.incr('verdict:accepted')
+        return Status(SYMBOLS[status]), bool(flags & self.LOG_DB), dbID or None, expiry
+
+    def onState(self, key, status, source):
+        # Tokens issued before the ray lost its verification are revoked, revocations older than any token are dropped
+        if status == Status.VERFIED.value:
+            return
+        now = int(time.time())
+        self.revoked[key] = now
+        if len(self.revoked) > 1024:
+            self.revoked = {key: revokeTime for key, revokeTime in self.revoked.items() if revokeTime > now - self.lifetime}
+
+    def reset(self):
+        self.resetTime = int(time.time())
+
+VERDICTS = VerdictTokens(VERDICT_TOKEN_LIFETIME, VERDICT_TOKEN_KEY_LIFETIME)
+STATE.subscribe(VERDICTS.onState, VERDICTS.reset)
@@ -0,0 +1,53 @@
+import bisect
+import ipaddress
+
+class Whitelist:
+    def __init__(self, subnets=()):
+        self.networks = []
+        self.index = self.build([])
+        self.add(*subnets)
+
+    def add(self, *subnets):
+        self.replace(self.networks + [self.parse(subnet) for subnet in subnets])
+
+    def replace(self, subnets):
+        # Index is built aside and swapped in one assignment, so lookups running meanwhile see either the old or the new list
+        networks = [self.parse(subnet) for subnet in subnets]
+        index = self.build(networks)
+        self.networks, self.index = networks, index
+
+    def parse(self, subnet):
+        if isinstance(subnet, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            return subnet
+        return ipaddress.ip_network(subnet.strip(), strict=False)
+
+    def build(self, networks):
+        # Per IP version: sorted starts and ends of merged ranges, so a lookup is a single bisect
+        index = {}
+        for version in [4, 6]:
+            ranges = sorted((int(network.network_address), int(network.broadcast_address)) for network in networks if network.version == version)
+            starts, ends = [], []
+            for start, end in ranges:
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            index[version] = (starts, ends)
+        return index
+
+    def contains(self, ip):
+        if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            ip = ipaddress.ip_address(ip)
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        starts, ends = self.index[ip.version]
+        value = int(ip)
+        position = bisect.bisect_right(starts, value) - 1
+        return position >= 0 and value <= ends[position]
+
+    def __contains__(self, ip):
+        return self.contains(ip)
+
+    def __len__(self):
+        return len(self.networks)
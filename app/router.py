@@ -1,16 +1,20 @@
 from fastapi import Request
-from fastapi.responses import Response
-import httpx
+from fastapi.responses import Response, StreamingResponse
 from app.challenges.full import FullChallenge
-from app.challenges.inject import InjectChallenge
+from app.challenges.inject import InjectChallenge, Script as InjectScript
+from app.challenges.paths import PATHS, SCRIPT
+from app.challenges import ScriptUnavailable
 
 import config
-from config import REDIS
 import time
 import json
 
 from app.endpoint import Endpoint, EndpointResponseStatus
+from app.batch import Batch
+from app.templates import TEMPLATE_403, TEMPLATE_502, TEMPLATE_503
+from app import stream, encoding, counters
 from app.ray.ray import Status as RayStatus
+from app.ray.verdict import VERDICTS
 from starlette.requests import ClientDisconnect
 
 class Router:
@@ -24,84 +28,24 @@ class Router:
                 host = request.headers.get('host', 'undefined')
                 if host in self.endpoints:
                     endpoint = self.endpoints[host]
+                    if PATHS.isCandidate(request.url.path):
+                        response = await self.routeScript(request)
+                        if response is not None:
+                            return response
                     handle = await endpoint.handleRequest(request)
-                    
-                    if handle.status in [EndpointResponseStatus.VERFIED, EndpointResponseStatus.JS_CHALLENGE]:
-                        if handle.status == EndpointResponseStatus.JS_CHALLENGE:
-                            challenge = InjectChallenge(handle.ray)
-                            if request.url.path == '/' + challenge.script.getScriptFilename():
-                                return Response(challenge.getScriptCode(), media_type='text/javascript')
-                            elif request.url.path == challenge.script.getScriptEndpoint():
-                                return await challenge.getResponse()
-                        
-                        response = None
-                        body = await request.body()
+                    try:
                         try:
-                            async with httpx.AsyncClient(follow_redirects=False, verify=False, cookies=request.cookies) as client:
-                                endpointResponse = await client.request(
-                                    method=request.method,
-                                    url=endpoint.getAddress() + path,
-                                    content=body,
-                                    headers=self.getRequestHeaders(request),
-                                    params=request.query_params,
-                                    timeout=120
-                                )
-                        except Exception as e:
-                            return Response(config.PAGE_502.replace('{{RAY_ID}}', handle.ray.getShortID()).replace('{{ENDPOINT_HOST}}', endpoint.host), 502)
-                        
-                        content = endpointResponse.content
-                        contentType = endpointResponse.headers.get('content-type', 'text/html')
-                        
-                        if handle.status == EndpointResponseStatus.JS_CHALLENGE:
-                            injectKey = 'ray:actions:' + handle.ray.group.name + ':' + handle.ray.id + ':inject'
-                            noInjectKey = 'ray:actions:' + handle.ray.group.name + ':' + handle.ray.id + ':noInject'
-                            
-                            if 'text/html' in contentType and content.startswith((b'<!DOCTYPE html>', b'<html')):
-                                if not REDIS.exists(injectKey + ':time'):
-                                    REDIS.set(injectKey + ':time', time.time(), ex=120)
-                                else:
-                                    if float(REDIS.get(injectKey + ':time')) - time.time() > 30:
-                                        if REDIS.exists(injectKey + ':data'):
-                                            if not challenge.predict(json.loads(REDIS.get(injectKey + ':data'))):
-                                                # Блокировка отключена для тестирования
-                                                print('not verfided by predict: ', handle.ray.ip)
-                                        else:
-                                            # Блокировка отключена для тестирования
-                                            print('where is no data, but time is expired: ', handle.ray.ip)
-                                
-                                injectCode = challenge.getInjectCode()
-                                content += injectCode
-                            elif handle.ray.savedScore == None and handle.ray.score == None:
-                                if not 'image' in contentType:
-                                    if REDIS.exists(noInjectKey):
-                                        REDIS.set(noInjectKey, int(config.REDIS.get(noInjectKey)) + 1, ex=60)
-                                    else:
-                                        REDIS.set(noInjectKey, 1, ex=60)
-                                    
-                                if REDIS.exists(noInjectKey) and int(config.REDIS.get(noInjectKey)) >= 20:
-                                    print('Got limited: ', handle.ray.ip)
-                                    handle.ray.status = RayStatus.FULL_JS_CHALLENGE
-                                    handle.ray.save()
-                                    response = await FullChallenge(handle.ray).getResponse()
-                                    REDIS.unlink(noInjectKey)
-
-                        if response == None:
-                            response = Response(
-                                content,
-                                endpointResponse.status_code, 
-                                self.getResponseHeaders(endpointResponse.headers)
-                            )
-        
-                            for cookie in [v.decode('utf-8') for k, v in endpointResponse.headers.raw if k.lower() == b'set-cookie']:
-                                response.headers.append('set-cookie', cookie)
-                                
-                            response.headers['content-length'] = str(len(content))
-                    elif handle.status == EndpointResponseStatus.FULL_JS_CHALLENGE:
-                        response = await FullChallenge(handle.ray).getResponse()
-                    elif handle.status == EndpointResponseStatus.BLOCKED:
-                        response = Response(config.PAGE_403.replace('{{RAY_ID}}', handle.ray.getShortID()), 403)
-                    else:
-                        response = Response('Sorry! Status: ' + handle.status.value + '. Ray ID: ' + handle.ray.getShortID())
+                            response = await self.respond(request, path, endpoint, handle)
+                            if config.VERDICT_TOKEN:
+                                await self.setVerdict(request, response, handle)
+                        finally:
+                            # All writes of the request go to Redis in one pipeline
+                            await handle.ray.batch.flush()
+                            handle.ray.batch.finish()
+                    except BaseException:
+                        # Response is thrown away, so the backend connection has to be released here
+                        await handle.close()
+                        raise
 
                     if not config.RAY_NAME in request.cookies or request.cookies[config.RAY_NAME] != handle.ray.id:
                        response.set_cookie(config.RAY_NAME, handle.ray.id, 32140800)
@@ -110,19 +54,197 @@ class Router:
                 else:
                     return Response('Undefined host', 404)
             except ClientDisconnect as e:
-                return Response(config.PAGE_503, 503)
+                return TEMPLATE_503.getResponse(request, 503)
             except Exception as e:
                 self.logger.exception(str(type(e)) + ': ' + str(e))
-                return Response(config.PAGE_503, 503)
+                return TEMPLATE_503.getResponse(request, 503)
             
         
+    async def routeScript(self, request):
+        # Inject scripts are served without loading the ray, unknown challenge-like paths may be rejected right away
+        route = await PATHS.get(request.url.path)
+        if route is None:
+            return Response('Not found', 404) if config.CHALLENGE_PATHS_REJECT_UNKNOWN else None
+        script, key, kind = route
+        if script is not InjectScript or kind != SCRIPT or request.method != 'GET':
+            return None
+        batch = Batch()
+        try:
+            script = await script.fetch(key, batch)
+        finally:
+            batch.finish()
+        if script is None:
+            return None
+        return script.getResponse(request)
+
+    async def respond(self, request, path, endpoint, handle):
+        try:
+            return await self.dispatch(request, path, endpoint, handle)
+        except ScriptUnavailable:
+            # Challenge scripts are never generated on request, the client comes back when the pool is filled
+            response = TEMPLATE_503.getResponse(request, 503, RAY_ID=handle.ray.getShortID())
+            response.headers['Retry-After'] = str(config.CHALLENGE_POOL_RETRY_AFTER)
+            return response
+
+    async def dispatch(self, request, path, endpoint, handle):
+        if handle.status in [EndpointResponseStatus.VERFIED, EndpointResponseStatus.JS_CHALLENGE]:
+            challenge = None
+            if handle.status == EndpointResponseStatus.JS_CHALLENGE:
+                challenge = await InjectChallenge(handle.ray).load()
+                if request.url.path == '/' + challenge.script.filename:
+                    return challenge.getScriptResponse()
+                elif request.url.path == challenge.script.endpoint:
+                    return await challenge.getResponse()
+
+            return await self.forward(request, path, endpoint, handle, challenge)
+        elif handle.status == EndpointResponseStatus.FULL_JS_CHALLENGE:
+            return await FullChallenge(handle.ray).getResponse()
+        elif handle.status == EndpointResponseStatus.BLOCKED:
+            return TEMPLATE_403.getResponse(request, 403, RAY_ID=handle.ray.getShortID())
+        else:
+            return Response('Sorry! Status: ' + handle.status.value + '. Ray ID: ' + handle.ray.getShortID())
+
+    async def setVerdict(self, request, response, handle):
+        if handle.ray.status == RayStatus.VERFIED:
+            # Token is reissued once half of its lifetime has passed
+            if handle.ray.verdictExpiry is None or handle.ray.verdictExpiry - time.time() < config.VERDICT_TOKEN_LIFETIME / 2:
+                token, handle.ray.verdictExpiry = await VERDICTS.sign(handle.ray)
+                # Requests served by the token do not save the ray, so its record is kept alive with the token
+                handle.ray.batch.expire(handle.ray.getKey(), config.RAY_LIFETIME)
+                handle.ray.batch.expire(handle.ray.getLogsKey(), config.RAY_LIFETIME)
+                response.set_cookie(config.VERDICT_TOKEN_NAME, token, config.VERDICT_TOKEN_LIFETIME, httponly=True, samesite='lax')
+        elif config.VERDICT_TOKEN_NAME in request.cookies:
+            response.delete_cookie(config.VERDICT_TOKEN_NAME)
+
+    async def forward(self, request, path, endpoint, handle, challenge):
+        body = None
+        bodyLength = request.headers.get('content-length')
+        if bodyLength is not None and int(bodyLength) > endpoint.maxBodySize:
+            return Response('Request body is too large', 413)
+        if (bodyLength is not None and int(bodyLength) > 0) or 'transfer-encoding' in request.headers:
+            body = stream.limit(request.stream(), endpoint.maxBodySize)
+
+        try:
+            endpointResponse = await endpoint.send(endpoint.client.build_request(
+                method=request.method,
+                url=endpoint.getAddress() + path,
+                content=body,
+                headers=self.getRequestHeaders(request),
+                params=request.query_params
+            ), stream=True)
+            handle.upstream = endpointResponse
+        except stream.BodyTooLarge:
+            return Response('Request body is too large', 413)
+        except ClientDisconnect:
+            raise
+        except Exception as e:
+            return TEMPLATE_502.getResponse(request, 502, RAY_ID=handle.ray.getShortID(), ENDPOINT_HOST=endpoint.host)
+
+        try:
+            # Raw chunks keep backend compression, they are decoded only when page has to be modified
+            content = endpointResponse.aiter_raw()
+            contentLength = endpointResponse.headers.get('content-length')
+            contentType = endpointResponse.headers.get('content-type', 'text/html')
+            contentEncoding = endpointResponse.headers.get('content-encoding', 'identity').lower()
+            status = endpointResponse.status_code
+            hasBody = request.method != 'HEAD' and status >= 200 and status not in (204, 304)
+            if not hasBody:
+                contentLength = None
+
+            if handle.status == EndpointResponseStatus.JS_CHALLENGE:
+                batch = handle.ray.batch
+                injectTimeKey = handle.ray.getActionKey('inject:time')
+                injectDataKey = handle.ray.getActionKey('inject:data')
+                noInjectKey = handle.ray.getActionKey('noInject')
+
+                # Anything which is not an HTML page getting the inject script is passed as it is
+                html = False
+                if hasBody and 'text/html' in contentType and encoding.getDecoder(contentEncoding) is not None:
+                    head, content = await encoding.peek(content, contentEncoding, 32)
+                    html = stream.isHTML(head)
+
+                if html:
+                    injectTime = await batch.setFirst(injectTimeKey, time.time(), ex=120)
+                    if float(injectTime) - time.time() > 30:
+                        injectData = counters.getScored(await batch.get(injectDataKey))
+                        if injectData is not None:
+                            if not await challenge.predict(json.loads(injectData)):
+                                # Блокировка отключена для тестирования
+                                self.logger.info('Not verfied by predict: ' + str(handle.ray.ip))
+                        else:
+                            # Блокировка отключена для тестирования
+                            self.logger.info('No inject data, but time is expired: ' + str(handle.ray.ip))
+
+                    injectCode = challenge.getInjectCode()
+                    if contentEncoding != 'identity':
+                        content = encoding.decode(content, contentEncoding)
+                        contentEncoding = 'identity'
+                        contentLength = None
+                    content = stream.inject(content, injectCode)
+                    if contentLength is not None:
+                        contentLength = str(int(contentLength) + len(injectCode))
+
+                    coding = encoding.choose(request.headers.get('accept-encoding'), contentLength)
+                    if coding is not None:
+                        content = encoding.compress(content, coding)
+                        contentEncoding = coding
+                        contentLength = None
+                elif handle.ray.savedScore == None and handle.ray.score == None:
+                    if not 'image' in contentType:
+                        noInject = await batch.incr(noInjectKey, ex=60)
+                    else:
+                        noInject = await batch.get(noInjectKey)
+                    if noInject is not None and int(noInject) >= 20:
+                        self.logger.info('Got limited: ' + str(handle.ray.ip))
+                        handle.ray.status = RayStatus.FULL_JS_CHALLENGE
+                        await handle.ray.save()
+                        batch.unlink(noInjectKey)
+                        await endpointResponse.aclose()
+                        return await FullChallenge(handle.ray).getResponse()
+
+            if endpoint.stream:
+                response = StreamingResponse(
+                    stream.closing(content, endpointResponse),
+                    status,
+                    self.getResponseHeaders(endpointResponse.headers)
+                )
+                if contentLength is not None:
+                    response.headers['content-length'] = contentLength
+            else:
+                content = await stream.collect(content)
+                await endpointResponse.aclose()
+                response = Response(
+                    content,
+                    status,
+                    self.getResponseHeaders(endpointResponse.headers)
+                )
+                if hasBody:
+                    response.headers['content-length'] = str(len(content))
+
+            if contentEncoding != 'identity':
+                response.headers['content-encoding'] = contentEncoding
+            if 'accept-encoding' not in response.headers.get('vary', '').lower():
+                response.headers.append('vary', 'Accept-Encoding')
+        except BaseException:
+            await endpointResponse.aclose()
+            raise
+
+        for cookie in [v.decode('utf-8') for k, v in endpointResponse.headers.raw if k.lower() == b'set-cookie']:
+            response.headers.append('set-cookie', cookie)
+
+        return response
+
     def addEndpoint(self, endpoint : Endpoint):
         self.endpoints[endpoint.host] = endpoint
 
+    async def close(self):
+        for endpoint in self.endpoints.values():
+            await endpoint.close()
+
     def getRequestHeaders(self, request):
         result = {k: v for k, v in request.headers.items() if k.lower() not in config.APP_HEADERS}
         result['x-byte4byte-ip'] = request.headers.get('x-forwarded-for')
-        result['accept-encoding'] = 'identity'
+        result['accept-encoding'] = encoding.getBackendEncoding(request.headers.get('accept-encoding'))
         return result
 
     def getResponseHeaders(self, headers):
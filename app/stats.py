@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+
+from config import PID, STATS_SAVE_PATH, STATS_SAVE_INTERVAL, getLogger
+
+class Stats:
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+        self.task = None
+        self.logger = getLogger('b4b.stats')
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        timing['count'] += 1
+        timing['total'] += value
+        if value > timing['max']:
+            timing['max'] = value
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def snapshot(self):
+        gauges = {}
+        for name, callback in self.gauges.items():
+            try:
+                gauges[name] = callback()
+            except Exception as e:
+                gauges[name] = None
+                self.logger.warning(f'Gauge {name} failed: {e}')
+
+        timings = {}
+        for name, timing in self.timings.items():
+            timings[name] = dict(timing, avg=timing['total'] / timing['count'] if timing['count'] else 0.0)
+
+        return {
+            'pid': PID,
+            'time': time.time(),
+            'counters': dict(self.counters),
+            'timings': timings,
+            'gauges': gauges
+        }
+
+    def save(self):
+        (STATS_SAVE_PATH / (str(PID) + '.json')).write_text(json.dumps(self.snapshot()))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.save()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(STATS_SAVE_INTERVAL)
+            try:
+                self.save()
+            except Exception as e:
+                self.logger.exception(e)
+
+STATS = Stats()
@@ -0,0 +1,52 @@
+import re
+
+class BodyTooLarge(Exception):
+    pass
+
+HTML_START = (b'<!doctype html', b'<html')
+BODY_END = re.compile(rb'</body', re.IGNORECASE)
+BODY_END_LEN = len(b'</body')
+
+async def prepend(head, chunks):
+    if head:
+        yield head
+    async for chunk in chunks:
+        yield chunk
+
+def isHTML(head):
+    return head.lstrip()[:len(HTML_START[0])].lower().startswith(HTML_START)
+
+async def inject(chunks, code):
+    # Keeps the last bytes of each chunk until the next one arrives, so a tag split between chunks is still found
+    held = b''
+    async for chunk in chunks:
+        data = held + chunk if held else chunk
+        match = BODY_END.search(data)
+        if match is not None:
+            yield data[:match.start()] + code + data[match.start():]
+            async for chunk in chunks:
+                yield chunk
+            return
+        held = data[-(BODY_END_LEN - 1):]
+        if len(data) > len(held):
+            yield data[:-len(held)]
+    yield held + code
+
+async def closing(chunks, response):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await response.aclose()
+
+async def collect(chunks):
+    return b''.join([chunk async for chunk in chunks])
+
+async def limit(chunks, size):
+    # Chunks are pulled only as fast as the backend accepts them, so the client upload is throttled with it
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            raise BodyTooLarge(total)
+        yield chunk
@@ -0,0 +1,80 @@
+import re
+import struct
+import zlib
+
+from fastapi.responses import Response
+
+from config import PAGE_403, PAGE_502, PAGE_503, PRECOMPRESS_GZIP_LEVEL
+from app import encoding
+
+PLACEHOLDER = re.compile(r'{{(\w+)}}')
+
+# Minimal gzip member header: no name, no mtime, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# Empty final deflate block
+DEFLATE_END = b'\x03\x00'
+
+def deflate(data, level):
+    # Raw deflate ending with a full flush, so the blocks do not refer to anything before them and can be concatenated
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+class Template:
+    # Page split at {{NAME}} placeholders once, rendering only joins the segments with the values
+    def __init__(self, text):
+        parts = PLACEHOLDER.split(text)
+        self.segments = [part.encode() for part in parts[0::2]]
+        self.names = parts[1::2]
+        self.deflated = [deflate(segment, PRECOMPRESS_GZIP_LEVEL) for segment in self.segments]
+        # Pages without placeholders are the same every time
+        self.static = None
+        if not self.names:
+            self.static = (self.render(), self.renderGzip())
+
+    def getValues(self, values):
+        # Missing values are rendered empty
+        return [str(values.get(name, '')).encode() for name in self.names]
+
+    def render(self, **values):
+        if self.static is not None:
+            return self.static[0]
+        parts = [self.segments[0]]
+        for value, segment in zip(self.getValues(values), self.segments[1:]):
+            parts.append(value)
+            parts.append(segment)
+        return b''.join(parts)
+
+    def renderGzip(self, **values):
+        # Static segments are compressed ahead, only the values are compressed per response.
+        # CRC and size of the trailer need the plain page, checksumming it is far cheaper than compressing it
+        if self.static is not None:
+            return self.static[1]
+        values = self.getValues(values)
+        parts = [GZIP_HEADER, self.deflated[0]]
+        plain = [self.segments[0]]
+        for value, segment, deflated in zip(values, self.segments[1:], self.deflated[1:]):
+            if value:
+                parts.append(deflate(value, 1))
+                plain.append(value)
+            parts.append(deflated)
+            plain.append(segment)
+        crc = 0
+        size = 0
+        for part in plain:
+            crc = zlib.crc32(part, crc)
+            size += len(part)
+        parts.append(DEFLATE_END)
+        parts.append(struct.pack('<II', crc, size & 0xffffffff))
+        return b''.join(parts)
+
+    def getResponse(self, request, status, **values):
+        headers = {'Vary': 'Accept-Encoding'}
+        accepted = encoding.parseAcceptEncoding(request.headers.get('accept-encoding') if request is not None else None)
+        if encoding.isAccepted(accepted, 'gzip'):
+            headers['Content-Encoding'] = 'gzip'
+            return Response(self.renderGzip(**values), status, headers=headers, media_type='text/html')
+        return Response(self.render(**values), status, headers=headers, media_type='text/html')
+
+TEMPLATE_403 = Template(PAGE_403)
+TEMPLATE_502 = Template(PAGE_502)
+TEMPLATE_503 = Template(PAGE_503)
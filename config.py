@@ -1,6 +1,7 @@
 from pathlib import Path
 import os
 import redis
+import redis.asyncio
 import json
 import joblib
 from db import Database
@@ -23,36 +24,98 @@ def getLogger(name):
 COLLECT_SESSIONS = False
 
 PID = os.getpid()
-REDIS = redis.Redis(host='localhost', port=6379, db=0)
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+REDIS_MAX_CONNECTIONS = 64
+REDIS_POOL_TIMEOUT = 5 # seconds to wait for a free connection
+REDIS = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT
+))
+REDIS_SYNC = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB) # Only for scripts running outside of event loop
 DB = Database(getLogger('b4b.db'))
 
 MODEL = joblib.load('model.dump')
 
-RAY_LEN = 256
+RAY_ID_RANDOM_BYTES = 10 # random part of ray ID, 24 characters in cookie together with time and node
+RAY_ID_NODE = None # 16 bit node of ray IDs, derived from host name and process ID when None
 RAY_LEN_SHORT = 12
 RAY_LIFETIME = 1800
 RAY_NAME = 'byte4byte.auth'
+RAY_STATE_CHANNEL = 'ray:state'
+RAY_WAIT_TIMEOUT = 5 # seconds, how long request may wait for verification of its ray
+RAY_CACHE_SIZE = 50000 # rays kept in memory of each worker
+RAY_CACHE_TTL = 3 # seconds, longest time a worker may serve ray state changed by another one
+VERDICT_CACHE_SIZE = 10000 # client fingerprints kept with their verdicts in each worker
+VERDICT_CACHE_TTL = 60 # seconds
+VERDICT_CACHE_SKIP_BLOCKED = True # Repeated blocked clients are only counted, in extra_data of the first ray with the verdict
+VERDICT_CACHE_FLUSH_INTERVAL = 10 # seconds, how often the counts of each client are added to its first ray in DB
+
+RATE_LIMIT_WINDOW = 60 # seconds
+RATE_LIMIT_SYNC_INTERVAL = 1 # seconds, how often each worker adds its counts to the shared ones in Redis
+# Requests per window by ray status, counted separately for client IP (IPv6 by /64), ray and JA4 fingerprint; None is no limit.
+# Rays over a limit get the 'escalate' status. Groups can override these with Group.setRateLimit
+RATE_LIMITS = {
+    'verfied': {'ip': 1200, 'ray': 600, 'ja4': None, 'escalate': 'full_js_challenge'},
+    'js_challenge': {'ip': 600, 'ray': 300, 'ja4': None, 'escalate': 'full_js_challenge'},
+    'full_js_challenge': {'ip': 300, 'ray': 120, 'ja4': None, 'escalate': 'blocked'},
+}
+
+VERDICT_TOKEN = True # Verified rays get a signed cookie, so their requests are served without Redis
+VERDICT_TOKEN_NAME = 'byte4byte.verdict'
+VERDICT_TOKEN_LIFETIME = 300 # seconds
+VERDICT_TOKEN_KEY_LIFETIME = 3600 # seconds, signing keys are rotated this often. Hint: Do not set less than VERDICT_TOKEN_LIFETIME
 
 ASSETS_PATH = Path.cwd() / 'assets'
 ASSETS_PATH.mkdir(parents=True, exist_ok=True)
 RESOURCES_PATH = Path.cwd() / 'resources'
 RESOURCES_PATH.mkdir(parents=True, exist_ok=True)
 STATS_SAVE_PATH = Path.cwd() / 'tmp' / 'stats'
-RESOURCES_PATH.mkdir(parents=True, exist_ok=True)
+STATS_SAVE_PATH.mkdir(parents=True, exist_ok=True)
+STATS_SAVE_INTERVAL = 10 # seconds
 
 FULL_CHALLENGE_SCRIPT = (ASSETS_PATH / 'full_challenge.js').read_text()
 FULL_CHALLENGE_SCRIPT_AMOUNT = 20
 FULL_CHALLENGE_SCRIPT_LIFETIME = 180 # Hint: Do not set less then 90s
+FULL_CHALLENGE_RULES = RESOURCES_PATH / 'full_challenge_rules.json'
 
 INJECT_CHALLENGE_SCRIPT = (ASSETS_PATH / 'inject_challenge.js').read_text()
 INJECT_CHALLENGE_SCRIPT_LIFETIME = 86400
 INJECT_CHALLENGE_SCRIPT_AMOUNT = 20
 INJECT_CHALLENGE_UNVERFIED_TIME_LIMIT = 20 # seconds
 
+CHALLENGE_PRODUCER_INTERVAL = 5 # seconds between checks of script pools
+CHALLENGE_PRODUCER_HORIZON = 15 # seconds, scripts which become unusable within this time are replaced ahead
+CHALLENGE_PRODUCER_LEADER_TTL = 30 # seconds, another worker takes over generation when the leader is gone this long
+CHALLENGE_POOL_WAIT = 3 # seconds a request waits for an empty pool to be filled
+CHALLENGE_POOL_RETRY_AFTER = 5 # seconds, Retry-After of the 503 response when the pool stays empty
+
+CHALLENGE_PATHS_REFRESH = 2 # seconds, how often an unknown challenge-like path may reload the path index
+CHALLENGE_PATHS_REJECT_UNKNOWN = False # Hint: Enable only if no backend path is 32 letters and digits, optionally with .js
+SCRIPT_CACHE_SIZE = 1000 # loaded challenge scripts kept by every worker
+
+OBFUSCATOR_WORKERS = os.cpu_count() or 1 # Node processes, started on first use
+OBFUSCATOR_TIMEOUT = 30 # seconds per script, the worker is restarted when exceeded
+
 PAGE_503 = minify((ASSETS_PATH / '503.html').read_text(), minify_css=True, minify_js=True)
 PAGE_502 = minify((ASSETS_PATH / '502.html').read_text(), minify_css=True, minify_js=True)
 PAGE_403 = minify((ASSETS_PATH / '403.html').read_text(), minify_css=True, minify_js=True)
 
+ENDPOINT_TIMEOUT = 120 # seconds
+ENDPOINT_CONNECT_TIMEOUT = 10 # seconds
+ENDPOINT_MAX_CONNECTIONS = 100
+ENDPOINT_MAX_KEEPALIVE_CONNECTIONS = 20
+ENDPOINT_KEEPALIVE_EXPIRY = 30 # seconds
+ENDPOINT_HTTP2 = False # Requires h2 package (httpx[http2])
+ENDPOINT_STREAMING = True # Forward response chunks as they arrive instead of buffering whole body
+ENDPOINT_MAX_BODY_SIZE = 100 * 1024 * 1024 # bytes
+
+PROXY_GZIP_LEVEL = 6
+PROXY_BROTLI_QUALITY = 5 # Requires brotli package
+PROXY_COMPRESS_MIN_SIZE = 1024 # bytes, smaller pages with injected script are sent uncompressed
+PRECOMPRESS_GZIP_LEVEL = 9 # for bodies compressed once and served many times, like challenge scripts
+PRECOMPRESS_BROTLI_QUALITY = 11 # Requires brotli package
+
 JA4_KEY_DETECT = '<<BOT>>'
 APP_HEADERS = ['x-forwarded-for', 'x-ja4-app', 'x-ja4-raw', 'x-ja4-fingerprint']
 
@@ -74,7 +137,7 @@ BOT_USERAGENT_KEYWORDS.extend([
 BOT_USERAGENT_KEYWORDS.extend([
     'bot', 'mastodon', 'https://', 'http://', 'whatsapp', 'twitter', 'facebook', 'chatgpt',
     'telegram', 'crawler', 'colly', 'phpcrawl', 'nutch', 'spider', 'scrapy', 'elinks',
-    'imageVacuum', 'apify', 'chrome-lighthouse', 'adsdefender', 'baidu', 'yandex',
+    'imageVacuum', 'apify', 'chrome-lighthouse', 'adsdefender', 'baidu', 'yandex', 'duckduckgo',
     'google', 'yahoo', 'bing', 'microsoftpreview',
 ]) # Web bots
 BOT_USERAGENT_KEYWORDS.extend([
@@ -82,10 +145,3 @@ BOT_USERAGENT_KEYWORDS.extend([
     'download', 'printer', 'router', 'camera', 'phillips hue', 'vpn', 'cisco', 'proxy', 'image',
     'office', 'fetcher', 'feed', 'photon', 'alittle client'
 ]) # Random bots
-
-import javascript
-JS_OBFUSCATOR = None
-def getObfuscator(renew=False):
-    if renew or JS_OBFUSCATOR is None:
-        JS_OBFUSCATOR = javascript.require('./node_modules/javascript-obfuscator/dist/index.js')
-    return JS_OBFUSCATOR
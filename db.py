@@ -223,6 +223,15 @@ class Database:
         finally:
             cur.close()
 
+    def addRayRepeats(self, ray_id, amount):
+        # Requests of the same client which got no rays of their own
+        q = """
+        UPDATE rays
+        SET extra_data = jsonb_set(COALESCE(extra_data, '{}'::jsonb), '{repeats}', to_jsonb(COALESCE((extra_data->>'repeats')::bigint, 0) + %s))
+        WHERE id = %s
+        """
+        self.execute(q, (int(amount), int(ray_id)))
+
     def updateRequest(self, request_id, data):
         allowed = {"ray_id", "time", "url", "status"}
         items = [(k, data[k]) for k in data if k in allowed]
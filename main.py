@@ -1,13 +1,32 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 import app.haproxy as haproxy
 from app.router import Router
+from app.stats import STATS
+from app.ray.state import STATE
+from app.challenges.producer import PRODUCER
+from app.obfuscator import OBFUSCATOR
 
 import config
 
 logger = config.getLogger('b4b.main')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    STATS.start()
+    STATE.start()
+    PRODUCER.start()
+    yield
+    await PRODUCER.stop()
+    await OBFUSCATOR.close()
+    await STATE.stop()
+    await router.close()
+    await config.REDIS.aclose()
+    await config.REDIS.connection_pool.disconnect()
+    await STATS.stop()
+
+app = FastAPI(lifespan=lifespan)
 hap = haproxy.HAProxy(app)
 router = Router(app)
 
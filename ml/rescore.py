@@ -0,0 +1,64 @@
+# uv run -m ml.rescore --rules resources/full_challenge_rules.json
+
+import argparse
+import time
+from pathlib import Path
+
+from config import DB, FULL_CHALLENGE_RULES
+from app.challenges.rules import RuleSet
+
+parser = argparse.ArgumentParser('Byte4Byte full challenge rules evaluation')
+parser.add_argument('--rules', help='rules to evaluate', default=str(FULL_CHALLENGE_RULES))
+parser.add_argument('--page', help='rays fetched at once', type=int, default=50000)
+parser.add_argument('--limit', help='stop after this many rays', type=int, default=None)
+args = parser.parse_args()
+
+rules = RuleSet.load(Path(args.rules))
+current = RuleSet.load(FULL_CHALLENGE_RULES)
+
+# Only rays stored with their payload can be scored again
+QUERY = """
+SELECT id, user_agent, score_logs FROM rays
+WHERE id > %s AND jsonb_typeof(score_logs) = 'object'
+ORDER BY id LIMIT %s
+"""
+
+total = 0
+changed = 0
+becameBot = 0
+becameHuman = 0
+reasons = {}
+scoreTime = 0
+lastID = 0
+while args.limit is None or total < args.limit:
+    rows = DB.execute(QUERY, (lastID, args.page), fetch=True)
+    if not rows:
+        break
+    lastID = rows[-1]['id']
+    records = [(row['score_logs'].get('data') or {}, {'userAgent': row['user_agent']}) for row in rows]
+
+    startTime = time.time_ns()
+    results = rules.rescore(records)
+    scoreTime += time.time_ns() - startTime
+
+    for row, (score, logs) in zip(rows, results):
+        total += 1
+        before = row['score_logs'].get('score')
+        if before != score:
+            changed += 1
+        if before is not None and current.isBot(before) != rules.isBot(score):
+            if rules.isBot(score):
+                becameBot += 1
+            else:
+                becameHuman += 1
+        for reason in logs:
+            # Values in reasons make them unique, only the text before them is counted
+            reason = reason.split(':')[0]
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+print('Rays:', total)
+print('Score changed:', changed)
+print('Became bot:', becameBot, 'became human:', becameHuman)
+print('Scoring time:', scoreTime / 1000000, 'ms', '(' + str(round(scoreTime / max(total, 1) / 1000, 2)) + ' us per ray)')
+for reason, count in sorted(reasons.items(), key=lambda item: -item[1]):
+    print(count, reason)
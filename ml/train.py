@@ -23,6 +23,8 @@ from sklearn.svm import SVC
 import joblib
 from pathlib import Path
 from ml.session import Session
+from config import BOT_USERAGENT_KEYWORDS
+from app.matcher import KeywordMatcher
 
 def _getUserAgentAccuracy(userAgent, ja4App):
     a = 0
@@ -33,28 +35,7 @@ def _getUserAgentAccuracy(userAgent, ja4App):
         t += 1
     return a / t
 
-BOT_USERAGENT_KEYWORDS = []
-BOT_USERAGENT_KEYWORDS.extend([
-    'golang', 'wget', 'curl', 'go-http-client', 'apache-httpclient', 'java', 'perl',
-    'python', 'openssl', 'headless', 'cypress', 'mechanicalsoup', 'grpc-go', 'okhttp',
-    'httpx', 'httpcore', 'aiohttp', 'httputil', 'urllib', 'guzzle', 'axios', 'ruby',
-    'zend_http_client', 'wordpress', 'symfony', 'httpclient', 'cpp-httplib', 'ngrok',
-    'malware', 'httprequest',
-]) # Basic bots
-BOT_USERAGENT_KEYWORDS.extend([
-    'scan', 'scanner', 'nessus', 'metasploit', 'zgrab', 'zmap', 'nmap', 'research', 'inspect',
-]) # Scanners
-BOT_USERAGENT_KEYWORDS.extend([
-    'bot', 'mastodon', 'https://', 'http://', 'whatsapp', 'twitter', 'facebook', 'chatgpt',
-    'telegram', 'crawler', 'colly', 'phpcrawl', 'nutch', 'spider', 'scrapy', 'elinks',
-    'imageVacuum', 'apify', 'chrome-lighthouse', 'adsdefender', 'baidu', 'yandex', 'duckduckgo',
-    'google', 'yahoo', 'bing', 'microsoftpreview',
-]) # Web bots
-BOT_USERAGENT_KEYWORDS.extend([
-    'mozilla/4.', 'mozilla/3.', 'mozilla/2.', 'fidget-spinner-bot', 'test-bot', 'tiny-bot',
-    'download', 'printer', 'router', 'camera', 'phillips hue', 'vpn', 'cisco', 'proxy', 'image',
-    'office', 'fetcher', 'feed', 'photon', 'alittle client'
-])
+BOT_USERAGENT_MATCHER = KeywordMatcher(BOT_USERAGENT_KEYWORDS)
 
 logger = logging.getLogger('b4b.ml')
 logger.setLevel(logging.DEBUG)
@@ -105,10 +86,8 @@ for sessionFile in path.iterdir():
                     elif session.ja4Fingerprint in ja4list.keys() and _getUserAgentAccuracy(session.userAgent, ja4list[session.ja4Fingerprint]) < 0.9:
                         session.label = 'bot'
                 
-                for word in BOT_USERAGENT_KEYWORDS:
-                    if word in session.userAgent:
-                        session.label = 'bot'
-                        break
+                if BOT_USERAGENT_MATCHER.search(session.userAgent) is not None:
+                    session.label = 'bot'
                     
                 if session.label == 'human':
                     if asn['ASN'] not in ['12389', '25513', '31133', '21299', '15378', '28840', '35125', '21299', '39001', '48573']:
@@ -1,18 +1,31 @@
+# uv run -m test.obfuscator
+
+import asyncio
+import os
 import time
-import javascript
 
-with open('./app/assets/captcha.js', 'r') as f:
-    js = f.read()
+from config import FULL_CHALLENGE_SCRIPT
+from app.obfuscator import ObfuscatorPool
+from app.challenges import OBFUSCATOR_OPTIONS
+
+COUNT = 32
+
+async def bench(size):
+    pool = ObfuscatorPool(size, 60)
+    # Workers are started outside of the measurement
+    await pool.obfuscateMany(['var warmup = 1;'] * size, OBFUSCATOR_OPTIONS)
+    startTime = time.time_ns()
+    results = await pool.obfuscateMany([FULL_CHALLENGE_SCRIPT] * COUNT, OBFUSCATOR_OPTIONS)
+    elapsed = (time.time_ns() - startTime) / 1000000000
+    await pool.close()
+    failed = sum(isinstance(result, Exception) for result in results)
+    print('workers:', size, 'scripts per second:', round(COUNT / elapsed, 2), 'ms per script:', round(elapsed * 1000 / COUNT, 2), 'failed:', failed)
 
-obfuscator = javascript.require('../node_modules/javascript-obfuscator/dist/index.js')
+async def main():
+    size = 1
+    while size < (os.cpu_count() or 1):
+        await bench(size)
+        size *= 2
+    await bench(os.cpu_count() or 1)
 
-timeStart = time.time_ns()
-print(obfuscator.obfuscate(js, {
-    'renameGlobals': True,
-    'compact': True,
-    'renameProperties': True,
-    'splitStrings': True,
-    'numbersToExpressions': True,
-    'selfDefending': True
-}).getObfuscatedCode())
-print('Time elapsed: ', (time.time_ns() - timeStart) / 1000000, 'ms')
\ No newline at end of file
+asyncio.run(main())
@@ -0,0 +1,20 @@
+# uv run -m test.ray_id
+
+import random
+import string
+import time
+
+from app.ray import ident
+
+COUNT = 100000
+
+def legacyID():
+    # Previous generator without its Redis exists check, which only made it slower
+    random.seed(time.time_ns())
+    return (''.join(random.choice(string.ascii_letters + string.digits) for _ in range(256))) + '.' + str(time.time_ns())
+
+for name, generate in [('legacy', legacyID), ('current', ident.generate)]:
+    startTime = time.time_ns()
+    ids = {generate() for _ in range(COUNT)}
+    elapsed = (time.time_ns() - startTime) / 1000000000
+    print(name, 'IDs per second:', int(COUNT / elapsed), 'length:', len(next(iter(ids))), 'unique:', len(ids) == COUNT)
@@ -1,6 +1,6 @@
 # uv run -m test.redis
 
-from config import REDIS
+from config import REDIS_SYNC as REDIS
 
 # REDIS.set('test', 'test', 10)
 # print(REDIS.ttl('test'))
@@ -11,4 +11,5 @@ from config import REDIS
 
 for key in REDIS.keys('challenges:full:*'):
     print(key)
-    print(REDIS.delete(key))
\ No newline at end of file
+    print(REDIS.delete(key))
+REDIS.delete('challenges:index:full')
\ No newline at end of file
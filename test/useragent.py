@@ -0,0 +1,47 @@
+# uv run -m test.useragent
+
+import random
+import string
+import time
+
+from config import BOT_USERAGENT_KEYWORDS
+from app.matcher import KeywordMatcher
+
+LOOPS = 5000
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Go-http-client/1.1',
+    'python-requests/2.31.0',
+]
+
+def bench(keywords):
+    def loop(userAgent):
+        for word in keywords:
+            if word in userAgent:
+                return word
+        return None
+
+    def loopLower(userAgent):
+        userAgent = userAgent.lower()
+        for word in keywords:
+            if word.lower() in userAgent:
+                return word
+        return None
+
+    matcher = KeywordMatcher(keywords)
+
+    for name, search in [('loop', loop), ('loop, case folded', loopLower), ('aho-corasick', matcher.search)]:
+        startTime = time.time_ns()
+        for _ in range(LOOPS):
+            for userAgent in USER_AGENTS:
+                search(userAgent)
+        elapsed = time.time_ns() - startTime
+        print(len(keywords), 'keywords,', name, (elapsed / (LOOPS * len(USER_AGENTS))) / 1000, 'us per user agent', [search(userAgent) for userAgent in USER_AGENTS])
+
+bench(BOT_USERAGENT_KEYWORDS)
+
+# Automaton does not slow down with longer lists
+random.seed(1)
+bench(BOT_USERAGENT_KEYWORDS + [''.join(random.choices(string.ascii_lowercase, k=8)) for _ in range(1000)])
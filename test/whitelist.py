@@ -1,22 +1,42 @@
+# uv run -m test.whitelist
+
 import ipaddress
+import random
 import time
 
-def is_ip_in_subnet(ip_str, subnet):
-    try:
-        ip = ipaddress.ip_address(ip_str)
-        return ip in subnet
-    except (ValueError, ipaddress.AddressValueError):
-        return False
-    
-startTime = time.time_ns()
-
-subnet_str = '2001:4860:4801:34::/64'
-if '/' in subnet_str:
-    subnet = ipaddress.ip_network(subnet_str, strict=False)
-else:
-    subnet = ipaddress.ip_network(f"{subnet_str}/{'128' if ip.version == 6 else '32'}", strict=False)
-
-ip = ipaddress.ip_address('2001:4860:4801:34::a')
-for _ in range(5000):
-    print(is_ip_in_subnet(ip, subnet))
-print('Time elapsed: ', (time.time_ns() - startTime)/1000000, 'ms')
\ No newline at end of file
+from config import SEARCH_SYSTEMS_BOT
+from app.ray.whitelist import Whitelist
+
+LOOKUPS = 5000
+
+def is_ip_in_subnet(ip, subnets):
+    for subnet in subnets:
+        if ip in subnet:
+            return True
+    return False
+
+def bench(name, subnets, ips):
+    networks = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+
+    startTime = time.time_ns()
+    whitelist = Whitelist(subnets)
+    print(name, 'subnets:', len(subnets), 'build:', (time.time_ns() - startTime)/1000000, 'ms')
+
+    startTime = time.time_ns()
+    linear = [is_ip_in_subnet(ip, networks) for ip in ips]
+    print(name, 'linear:', (time.time_ns() - startTime)/1000000, 'ms')
+
+    startTime = time.time_ns()
+    indexed = [ip in whitelist for ip in ips]
+    print(name, 'indexed:', (time.time_ns() - startTime)/1000000, 'ms')
+    print(name, 'same results:', linear == indexed, 'matched:', sum(indexed))
+
+random.seed(1)
+ips = [ipaddress.ip_address('2001:4860:4801:34::a'), ipaddress.ip_address('66.249.66.1')]
+ips += [ipaddress.ip_address(random.getrandbits(32)) for _ in range(LOOKUPS // 2)]
+ips += [ipaddress.ip_address((0x20014860 << 96) | random.getrandbits(96)) for _ in range(LOOKUPS // 2)]
+bench('search systems', SEARCH_SYSTEMS_BOT, ips)
+
+# Size of cloud provider lists
+cloud = [str(ipaddress.ip_network((random.getrandbits(24) << 8, 24))) for _ in range(50000)]
+bench('cloud', cloud, ips[:500])